@@ -0,0 +1,154 @@
+# Fills a room with simulated players and reports latency percentiles and throughput per route.
+# Runs the app through Flask's test client on mongomock by default, so no server is needed;
+# set COZYQUIZ_MONGO_BACKEND=pymongo to run against a real MongoDB instead.
+#
+#   python benchmarks/loadTest.py --players 200 --questions 10 --concurrency 16 --output load.json
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('COZYQUIZ_MONGO_BACKEND', 'mongomock')
+
+from index import app, faker
+
+QUESTION_ID = re.compile(r'name="questionId" value="([0-9a-f]{24})"')
+
+timings = {}
+timingsLock = Lock()
+
+
+def timed(route, call, *args, **kwargs):
+    start = time.perf_counter()
+    response = call(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    with timingsLock:
+        timings.setdefault(route, []).append(elapsed)
+    if response.status_code >= 400:
+        raise RuntimeError(f"{route} answered {response.status_code}")
+    return response
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def createRoom(owner, questionCount, answersPerQuestion):
+    username = f"{faker.user_name()}{random.randrange(10 ** 6)}"
+    password = faker.password()
+    timed('signup', owner.post, '/signup', data={'username': username, 'password': password})
+    timed('login', owner.post, '/login', data={'username': username, 'password': password})
+    room_id = timed('createQuiz', owner.get, '/createQuiz').headers['Location'].rsplit('/', 1)[1]
+    for i in range(questionCount):
+        correct = random.randrange(answersPerQuestion)
+        timed('newQuestion', owner.post, f'/rooms/{room_id}/questions/new', data={
+            'questionText': faker.sentence(),
+            'answer': [faker.word() for n in range(answersPerQuestion)],
+            'answerBgColor': [faker.hex_color() for n in range(answersPerQuestion)],
+            'answerTextColor': ['#212529'] * answersPerQuestion,
+            f'correct{correct}': 'yes',
+        })
+    return room_id
+
+
+def playQuiz(room_id, answersPerQuestion):
+    player = app.test_client()
+    timed('enterQuiz', player.post, '/enterQuiz',
+          data={'username': f"{faker.first_name()}{random.randrange(10 ** 9)}", 'room_code': room_id})
+    while True:
+        response = timed('answerQuiz GET', player.get, f'/answerQuiz/{room_id}/')
+        if response.status_code == 302:
+            break
+        questionId = QUESTION_ID.search(response.get_data(as_text=True)).group(1)
+        timed('answerQuiz POST', player.post, f'/answerQuiz/{room_id}/',
+              data={'questionId': questionId, 'answerNumber': random.randrange(answersPerQuestion)})
+    timed('showResults', player.get, f'/results/{room_id}')
+
+
+def watchResults(owner, room_id, finished):
+    while not finished.is_set():
+        timed('showRoomResults', owner.get, f'/rooms/{room_id}/results')
+    timed('showRoomResults', owner.get, f'/rooms/{room_id}/results')
+
+
+def currentCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def summarize(elapsed):
+    routes = {}
+    for route, values in sorted(timings.items()):
+        values.sort()
+        routes[route] = {
+            'requests': len(values),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            'throughput_rps': round(len(values) / elapsed, 2),
+        }
+    timings.clear()
+    return routes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a full room of quiz participants')
+    parser.add_argument('--players', type=int, default=100)
+    parser.add_argument('--questions', type=int, default=10)
+    parser.add_argument('--answers', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    app.config['TESTING'] = True
+    owner = app.test_client()
+    start = time.perf_counter()
+    room_id = createRoom(owner, args.questions, args.answers)
+    setup = summarize(time.perf_counter() - start)
+
+    # the owner keeps refreshing the results page while the players go through the quiz
+    finished = Event()
+    watcher = Thread(target=watchResults, args=(owner, room_id, finished))
+    start = time.perf_counter()
+    watcher.start()
+    try:
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            players = [executor.submit(playQuiz, room_id, args.answers) for i in range(args.players)]
+            for player in players:
+                player.result()
+    finally:
+        finished.set()
+        watcher.join()
+    elapsed = time.perf_counter() - start
+    routes = summarize(elapsed)
+
+    report = {
+        'commit': currentCommit(),
+        'backend': os.environ['COZYQUIZ_MONGO_BACKEND'],
+        'players': args.players,
+        'questions': args.questions,
+        'answers': args.answers,
+        'concurrency': args.concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'setup': setup,
+        'routes': routes,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
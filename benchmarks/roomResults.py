@@ -0,0 +1,79 @@
+# Compares the two ways of counting answers for the owner's results page.
+# Seeds a throwaway database with fake participants, so it needs a running MongoDB
+# (or COZYQUIZ_MONGO_BACKEND=mongomock to try it offline).
+#
+#   python benchmarks/roomResults.py --results 10000 --questions 10
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import repository
+from index import faker
+
+
+def seedRoom(db, questionCount, resultCount, answersPerQuestion):
+    room_id = db.rooms.insert_one({"owner": faker.user_name(), "joinedCount": 0}).inserted_id
+    questionIds = []
+    for i in range(questionCount):
+        answers = [{'number': n, 'text': faker.word(), 'bgColor': '#eeeeee', 'textColor': '#212529',
+                    'correct': n == 0} for n in range(answersPerQuestion)]
+        questionIds.append(db.questions.insert_one({'roomId': room_id, 'text': faker.sentence(),
+                                                    'answers': answers}).inserted_id)
+    batch = []
+    for i in range(resultCount):
+        answers = []
+        for question_id in questionIds:
+            answerNumber = random.randrange(answersPerQuestion)
+            answers.append({'questionId': question_id, 'answerNumber': answerNumber, 'correct': answerNumber == 0})
+        batch.append({'roomId': room_id, 'user': f"{faker.user_name()}{i}", 'answers': answers})
+        if len(batch) == 1000:
+            db.results.insert_many(batch)
+            batch = []
+    if batch:
+        db.results.insert_many(batch)
+    return room_id
+
+
+def timeCounter(counter, room_id, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        counts = counter(room_id)
+        timings.append(time.perf_counter() - start)
+    return counts, min(timings), sum(timings) / len(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the room results answer counters')
+    parser.add_argument('--results', type=int, default=10000)
+    parser.add_argument('--questions', type=int, default=10)
+    parser.add_argument('--answers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--database', default='cozyQuizBenchmark')
+    args = parser.parse_args()
+
+    db = repository.connect(database=args.database)
+    repository.client.drop_database(args.database)
+    try:
+        start = time.perf_counter()
+        room_id = seedRoom(db, args.questions, args.results, args.answers)
+        print(f"seeded {args.results} results x {args.questions} questions in {time.perf_counter() - start:.2f}s")
+
+        expected = None
+        for name, counter in repository.ANSWER_COUNTERS.items():
+            counts, best, mean = timeCounter(counter, room_id, args.repeat)
+            if expected is None:
+                expected = counts
+            elif counts != expected:
+                print(f"{name}: counts differ from the other strategy!")
+            print(f"{name:>10}: best {best * 1000:.1f} ms, mean {mean * 1000:.1f} ms")
+    finally:
+        repository.client.drop_database(args.database)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# Starts serve.py with an increasing number of worker processes and reports, for each count,
+# the cold start (launch until the first page is served) and the throughput of a fixed set of clients.
+# The pages requested need no data, so it also runs on mongomock; set COZYQUIZ_MONGO_BACKEND=pymongo
+# to include the per-request MongoDB round trips.
+#
+#   python benchmarks/workers.py --workers 1 2 4 --clients 16 --duration 10 --output workers.json
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PATHS = ['/', '/enterQuiz', '/login', '/signup']
+
+
+def freePort():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def get(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def startServer(workers, threads, port):
+    env = dict(os.environ, COZYQUIZ_SECRET_KEY='benchmark')
+    env.setdefault('COZYQUIZ_MONGO_BACKEND', 'mongomock')
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'serve.py'), '--server', 'builtin',
+                               '--workers', str(workers), '--threads', str(threads), '--bind', f'127.0.0.1:{port}'],
+                              env=env, stderr=subprocess.DEVNULL)
+    while True:
+        try:
+            if get(port, '/') == 200:
+                return server, time.perf_counter() - start
+        except OSError:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError(f"serve.py exited with {server.returncode}")
+        time.sleep(0.01)
+
+
+# one client process requests the pages in turn until the deadline, returns its latencies
+def runClient(port, deadline):
+    latencies = []
+    i = 0
+    while time.time() < deadline:
+        start = time.perf_counter()
+        status = get(port, PATHS[i % len(PATHS)])
+        latencies.append(time.perf_counter() - start)
+        if status != 200:
+            raise RuntimeError(f"{PATHS[i % len(PATHS)]} answered {status}")
+        i += 1
+    return latencies
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def measure(workers, threads, clients, duration, warmup):
+    port = freePort()
+    server, coldStart = startServer(workers, threads, port)
+    try:
+        with ProcessPoolExecutor(clients) as executor:
+            # every worker imports the app on its own, the warmup lets all of them finish before measuring
+            list(executor.map(runClient, [port] * clients, [time.time() + warmup] * clients))
+            results = list(executor.map(runClient, [port] * clients, [time.time() + duration] * clients))
+    finally:
+        server.terminate()
+        server.wait()
+    latencies = sorted(latency for result in results for latency in result)
+    return {
+        'workers': workers,
+        'cold_start_s': round(coldStart, 3),
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / duration, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+    }
+
+
+def currentCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=ROOT).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start and throughput of serve.py per worker count')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help='seconds measured per worker count')
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    runs = [measure(workers, args.threads, args.clients, args.duration, args.warmup) for workers in args.workers]
+    base = runs[0]
+    for run in runs:
+        run['speedup'] = round(run['throughput_rps'] / base['throughput_rps'], 2)
+        added = run['workers'] - base['workers']
+        run['gain_per_added_worker_rps'] = round((run['throughput_rps'] - base['throughput_rps']) / added, 2) if added else None
+
+    report = {
+        'commit': currentCommit(),
+        'backend': os.environ.get('COZYQUIZ_MONGO_BACKEND', 'mongomock'),
+        'cpus': os.cpu_count(),
+        'threads': args.threads,
+        'clients': args.clients,
+        'duration_s': args.duration,
+        'runs': runs,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import csv
+import io
+import json
+import re
+
+
+# question banks are read and written one line at a time, so a file of any size
+# only ever keeps one batch of questions in memory
+#
+# JSON Lines: one question per line
+#   {"text": "...", "timeLimit": 20, "answers": [{"number": 0, "text": "...", "bgColor": "#eeeeee", "textColor": "#212529", "correct": true}]}
+# CSV: one answer per row, a question starts on every row with number 0
+#   question,number,text,bgColor,textColor,correct,timeLimit
+# timeLimit is optional, in seconds, questions without one are not timed
+
+CSV_QUESTION_COLUMNS = ['question', 'number', 'text', 'bgColor', 'textColor', 'correct', 'timeLimit']
+CSV_RESULT_COLUMNS = ['user', 'questionId', 'answerNumber', 'correct']
+DEFAULT_BG_COLOR = '#eeeeee'
+DEFAULT_TEXT_COLOR = '#212529'
+COLOR = re.compile(r'^#[0-9a-fA-F]{6}$')
+TRUE_VALUES = {'true', 'yes', '1', 'y'}
+FALSE_VALUES = {'false', 'no', '0', 'n', ''}
+MAX_ERRORS = 100
+MAX_TIME_LIMIT = 3600
+
+
+class InvalidQuestion(ValueError):
+    pass
+
+
+def parseBool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in TRUE_VALUES | FALSE_VALUES:
+        return value.strip().lower() in TRUE_VALUES
+    raise InvalidQuestion(f"correct must be true or false, got {value!r}")
+
+
+# checks a question against the schema newQuestion writes and returns a clean copy of it
+def validateQuestion(question):
+    if not isinstance(question, dict):
+        raise InvalidQuestion('a question must be an object')
+    text = question.get('text')
+    if not isinstance(text, str) or text.strip() == '':
+        raise InvalidQuestion('the question text is missing')
+    answers = question.get('answers')
+    if not isinstance(answers, list) or answers == []:
+        raise InvalidQuestion('a question needs at least one answer')
+    answerList = []
+    for i, answer in enumerate(answers):
+        if not isinstance(answer, dict):
+            raise InvalidQuestion(f"answer {i} must be an object")
+        number = answer.get('number', i)
+        if isinstance(number, str) and number.strip().isdigit():
+            number = int(number)
+        if number != i:
+            raise InvalidQuestion(f"answer {i} has number {number!r}, answers must be numbered 0, 1, 2...")
+        answerText = answer.get('text')
+        if not isinstance(answerText, str) or answerText.strip() == '':
+            raise InvalidQuestion(f"answer {i} has no text")
+        bgColor = answer.get('bgColor') or DEFAULT_BG_COLOR
+        textColor = answer.get('textColor') or DEFAULT_TEXT_COLOR
+        for color in (bgColor, textColor):
+            if not isinstance(color, str) or not COLOR.match(color):
+                raise InvalidQuestion(f"answer {i} has an invalid color {color!r}")
+        answerList.append({'number': i, 'text': answerText, 'bgColor': bgColor, 'textColor': textColor,
+                           'correct': parseBool(answer.get('correct', False))})
+    validated = {'text': text, 'answers': answerList}
+    timeLimit = parseTimeLimit(question.get('timeLimit'))
+    if timeLimit is not None:
+        validated['timeLimit'] = timeLimit
+    return validated
+
+
+def parseTimeLimit(value):
+    if value is None or (isinstance(value, str) and value.strip() == ''):
+        return None
+    timeLimit = None
+    if not isinstance(value, bool):
+        try:
+            timeLimit = float(value)
+        except (TypeError, ValueError):
+            pass
+    if timeLimit is None or not 0 < timeLimit <= MAX_TIME_LIMIT:
+        raise InvalidQuestion(f"timeLimit must be a number of seconds up to {MAX_TIME_LIMIT}, got {value!r}")
+    return int(timeLimit) if timeLimit.is_integer() else timeLimit
+
+
+# both parsers yield (line number, question or InvalidQuestion) so one bad row does not stop an import
+def parseQuestionsJsonl(lines):
+    for lineNumber, line in enumerate(lines, 1):
+        if line.strip() == '':
+            continue
+        try:
+            yield lineNumber, validateQuestion(json.loads(line))
+        except json.JSONDecodeError as error:
+            yield lineNumber, InvalidQuestion(f"invalid JSON: {error.msg}")
+        except InvalidQuestion as error:
+            yield lineNumber, error
+
+
+def parseQuestionsCsv(lines):
+    reader = csv.DictReader(lines)
+    question = None
+    questionLine = None
+    for row in reader:
+        if (row.get('number') or '').strip() in ('', '0'):
+            if question is not None:
+                yield questionLine, validatedOrError(question)
+            question = {'text': row.get('question'), 'timeLimit': row.get('timeLimit'), 'answers': []}
+            questionLine = reader.line_num
+        elif question is None:
+            yield reader.line_num, InvalidQuestion('answer row before any question, the first answer of a question has number 0')
+            continue
+        question['answers'].append({'number': row.get('number'), 'text': row.get('text'),
+                                    'bgColor': row.get('bgColor'), 'textColor': row.get('textColor'),
+                                    'correct': row.get('correct') or ''})
+    if question is not None:
+        yield questionLine, validatedOrError(question)
+
+
+def validatedOrError(question):
+    try:
+        return validateQuestion(question)
+    except InvalidQuestion as error:
+        return error
+
+
+PARSERS = {'jsonl': parseQuestionsJsonl, 'csv': parseQuestionsCsv}
+
+
+# inserts the valid questions with insertMany(questions) every batchSize questions,
+# returns how many were imported and the first MAX_ERRORS (line, message) errors
+def importQuestions(parsed, insertMany, batchSize=500):
+    imported = 0
+    errors = []
+    batch = []
+    for lineNumber, question in parsed:
+        if isinstance(question, InvalidQuestion):
+            if len(errors) < MAX_ERRORS:
+                errors.append((lineNumber, str(question)))
+            continue
+        batch.append(question)
+        if len(batch) == batchSize:
+            insertMany(batch)
+            imported += len(batch)
+            batch = []
+    if batch:
+        insertMany(batch)
+        imported += len(batch)
+    return imported, errors
+
+
+def exportQuestionsJsonl(questions):
+    for question in questions:
+        exported = {'text': question['text'], 'answers': question['answers']}
+        if question.get('timeLimit') is not None:
+            exported['timeLimit'] = question['timeLimit']
+        yield json.dumps(exported) + '\n'
+
+
+def exportQuestionsCsv(questions):
+    yield csvLine(CSV_QUESTION_COLUMNS)
+    for question in questions:
+        for answer in question['answers']:
+            yield csvLine([question['text'], answer['number'], answer['text'], answer['bgColor'],
+                           answer['textColor'], 'true' if answer['correct'] else 'false', question.get('timeLimit', '')])
+
+
+def exportResultsJsonl(results):
+    for result in results:
+        answers = [{'questionId': str(answer['questionId']), 'answerNumber': answer['answerNumber'],
+                    'correct': answer['correct']} for answer in result['answers']]
+        yield json.dumps({'user': result['user'], 'answers': answers}) + '\n'
+
+
+def exportResultsCsv(results):
+    yield csvLine(CSV_RESULT_COLUMNS)
+    for result in results:
+        for answer in result['answers']:
+            yield csvLine([result['user'], str(answer['questionId']), answer['answerNumber'],
+                           'true' if answer['correct'] else 'false'])
+
+
+def csvLine(values):
+    line = io.StringIO()
+    csv.writer(line).writerow(values)
+    return line.getvalue()
+
+
+QUESTION_EXPORTERS = {'jsonl': exportQuestionsJsonl, 'csv': exportQuestionsCsv}
+RESULT_EXPORTERS = {'jsonl': exportResultsJsonl, 'csv': exportResultsCsv}
+MIMETYPES = {'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+# small thread-safe LRU map whose entries also expire after ttl seconds,
+# hits and misses are counted so the size can be tuned from the stats
+class LRUCache:
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.reported = (0, 0)
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, version=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entryVersion, expires, value = entry
+                if entryVersion == version and expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, version=None):
+        with self.lock:
+            self.entries[key] = (version, time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses}
+
+    # hits and misses since the previous call, for counters kept outside the process
+    def takeCounts(self):
+        with self.lock:
+            reportedHits, reportedMisses = self.reported
+            self.reported = (self.hits, self.misses)
+            return self.hits - reportedHits, self.misses - reportedMisses
@@ -0,0 +1,98 @@
+from bisect import bisect_left
+
+
+# upper bounds in seconds of the answer time histogram kept per question, the last bucket holds slower answers
+ANSWER_TIME_BUCKETS = (0.5, 1, 1.5, 2, 3, 4, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120)
+
+
+# compact answer key of a room, compiled once per question version so grading an answer
+# and rendering a player's results never walk the full question documents again
+class QuestionKey:
+    __slots__ = ('position', 'text', 'correctMask', 'answerCount', 'display', 'timeLimit')
+
+    def __init__(self, position, text, correctMask, answerCount, display, timeLimit=None):
+        self.position = position
+        self.text = text
+        self.correctMask = correctMask
+        self.answerCount = answerCount
+        self.display = display
+        self.timeLimit = timeLimit
+
+    def isValid(self, answerNumber):
+        return isinstance(answerNumber, int) and not isinstance(answerNumber, bool) and 0 <= answerNumber < self.answerCount
+
+    def isCorrect(self, answerNumber):
+        return (self.correctMask >> answerNumber) & 1 == 1
+
+
+# maps question id to its QuestionKey, position follows the order the questions are served in
+def compileAnswerKey(questions):
+    answerKey = {}
+    for position, question in enumerate(questions):
+        correctMask = 0
+        display = []
+        for answer in question['answers']:
+            if answer['correct']:
+                correctMask |= 1 << answer['number']
+            display.append({'text': answer['text'], 'bgColor': answer['bgColor'], 'textColor': answer['textColor'],
+                            'check': True if answer['correct'] else None})
+        answerKey[question['_id']] = QuestionKey(position, question['text'], correctMask, len(display), tuple(display),
+                                                 question.get('timeLimit'))
+    return answerKey
+
+
+# bit i is set when the player got the question at position i right
+def correctBits(answerKey, answers):
+    bits = 0
+    for answer in answers:
+        questionKey = answerKey.get(answer['questionId'])
+        if questionKey is not None and questionKey.isCorrect(answer['answerNumber']):
+            bits |= 1 << questionKey.position
+    return bits
+
+
+def countBits(bits):
+    return bin(bits).count('1')
+
+
+# a right answer is worth maxPoints, on a timed question it loses up to half of them as the time runs out.
+# Answers later than the limit (plus grace for the network) or to a question that was never delivered score 0
+def answerPoints(correct, elapsed, timeLimit, maxPoints, grace=0):
+    if not correct:
+        return 0
+    if timeLimit is None:
+        return maxPoints
+    if elapsed is None or elapsed > timeLimit + grace:
+        return 0
+    return round(maxPoints * (1 - min(elapsed, timeLimit) / timeLimit / 2))
+
+
+def timeBucket(seconds):
+    return bisect_left(ANSWER_TIME_BUCKETS, seconds)
+
+
+# percentiles of a histogram stored as {bucket index: count}, interpolated inside the bucket they fall in.
+# Returns None for a percentile in the last, unbounded bucket and when there are no answers
+def timePercentiles(buckets, fractions):
+    counts = [0] * (len(ANSWER_TIME_BUCKETS) + 1)
+    for bucket, count in buckets.items():
+        counts[int(bucket)] += count
+    total = sum(counts)
+    percentiles = []
+    for fraction in fractions:
+        if total == 0:
+            percentiles.append(None)
+            continue
+        rank = fraction * total
+        seen = 0
+        for bucket, count in enumerate(counts):
+            if count and seen + count >= rank:
+                break
+            seen += count
+        if bucket == len(ANSWER_TIME_BUCKETS):
+            percentiles.append(None)
+            continue
+        lower = ANSWER_TIME_BUCKETS[bucket - 1] if bucket > 0 else 0
+        upper = ANSWER_TIME_BUCKETS[bucket]
+        percentiles.append(lower + (upper - lower) * (rank - seen) / count)
+    return percentiles
@@ -1,54 +1,227 @@
-from flask import Flask, request, render_template, url_for, redirect, flash, session, send_from_directory
+from flask import Flask, Response, request, make_response, render_template, url_for, redirect, flash, session, send_from_directory
 from flask_httpauth import HTTPBasicAuth
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 import os
+import time
+import json
+from threading import BoundedSemaphore, Condition, Lock
 from bson.objectid import ObjectId
 from faker import Faker
+from bisect import bisect_right
+from cache import LRUCache
+import repository
+import bulk
+import grading
+import metrics
+import passwords
+import click
+import hashlib
+import io
+import re
+from markupsafe import Markup
+from werkzeug.exceptions import RequestEntityTooLarge
+try:
+    from PIL import Image, ImageOps
+except ImportError: # without Pillow profile pics are kept as uploaded
+    Image = None
 
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+PROFILE_PIC_SIZES = (64, 125, 250) # square thumbnails kept for every uploaded profile pic
+CONTENT_HASHED_FILE = re.compile(r'^[0-9a-f]{32}(-\d+)?\.(jpg|jpeg|png)$')
 
 
 faker = Faker()
-client = MongoClient('localhost', 27017)
-db = client.cozyQuiz
 app = Flask(__name__)
 app.secret_key = 'super secret key'
 app.config['UPLOAD_FOLDER'] = './upload'
+app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024 # largest request body, question bank imports are the biggest uploads
+app.config['PROFILE_PIC_MAX_BYTES'] = 4 * 1024 * 1024
+app.config['PROFILE_PIC_MAX_PIXELS'] = 4096 * 4096 # larger pictures are refused before they are decoded
+app.config['PROFILE_PIC_MAX_AGE'] = 365 * 24 * 60 * 60 # content hashed pics never change, so browsers can keep them
 app.config['SECRET_KEY'] = 'super secret key'
+app.config['IDENTITY_TTL'] = 300 # seconds before the session identity is checked against the database
+app.config['QUESTION_CACHE_SIZE'] = 256 # rooms
+app.config['QUESTION_CACHE_TTL'] = 300 # seconds
+app.config['LIVE_FEED_TIMEOUT'] = 10 # seconds an idle live results stream waits before re-reading the counters,
+                                     # answers recorded by another worker process only wake it up after this
+app.config['LIVE_FEED_INTERVAL'] = 0.5 # seconds between two live results updates, answers in between are batched
+app.config['LIVE_FEED_MAX_STREAMS'] = 2 # open live results streams per worker process, each one holds a request thread
+app.config['LIVE_FEED_DURATION'] = 60 # seconds before a stream ends and frees its thread, the browser then reconnects
+app.config['LIVE_FEED_RETRY'] = 2 # seconds the browser waits before reconnecting
+app.config['IMPORT_BATCH_SIZE'] = 500 # questions per insert_many when importing a question bank
+app.config['LEADERBOARD_SIZE'] = 10
+app.config['QUESTION_POINTS'] = 1000 # points of a right answer, timed questions give fewer the slower it comes
+app.config['ANSWER_TIME_GRACE'] = 1.0 # seconds an answer may arrive after the time limit, for the network
+app.config['FRAGMENT_CACHE_SIZE'] = 4096 # rendered question cards and room question lists
+app.config['FRAGMENT_CACHE_TTL'] = 600 # seconds
+app.config['SCORE_CACHE_SIZE'] = 256 # rooms whose sorted scores are kept for ranks
+app.config['SCORE_CACHE_TTL'] = 300 # seconds
+app.config['METRICS_FLUSH_INTERVAL'] = 5 # seconds a worker keeps its metrics before adding them to the shared totals
+app.config['ANSWER_COUNTER'] = 'aggregate' # 'aggregate' runs in MongoDB, 'linear' counts in one pass here
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt' # werkzeug method string, e.g. 'scrypt:16384:8:1' or 'pbkdf2:sha256:600000'
+app.config['PASSWORD_HASH_WORKERS'] = 2 # threads computing password hashes
+app.config['PASSWORD_HASH_QUEUE'] = 2 # hashes allowed to wait for a worker. Hash workers + queue + LIVE_FEED_MAX_STREAMS
+                                      # stays below serve.py's threads, so quiz pages always have threads left
+app.config['LOGIN_MAX_FAILURES'] = 5 # failed logins per username within LOGIN_FAILURE_WINDOW
+app.config['LOGIN_MAX_FAILURES_PER_IP'] = 100 # a whole class often logs in from the same address
+app.config['LOGIN_FAILURE_WINDOW'] = 300 # seconds
 auth = HTTPBasicAuth()
+repository.EVENT_LISTENERS.append(metrics.MongoCommandListener())
 
 
+# flask settings without a default of their own, so their type cannot be taken from it
+CONFIG_TYPES = {
+    'PROPAGATE_EXCEPTIONS': bool,
+    'TRAP_BAD_REQUEST_ERRORS': bool,
+    'TEMPLATES_AUTO_RELOAD': bool,
+    'SEND_FILE_MAX_AGE_DEFAULT': int,
+    'PERMANENT_SESSION_LIFETIME': int, # seconds
+    'SECRET_KEY': str,
+    'SERVER_NAME': str,
+    'SESSION_COOKIE_DOMAIN': str,
+    'SESSION_COOKIE_PATH': str,
+    'SESSION_COOKIE_SAMESITE': str,
+}
+
+
+# config values can be overridden from the environment as COZYQUIZ_<KEY>, e.g. COZYQUIZ_SECRET_KEY. The value is
+# converted to the type of the default or the one in CONFIG_TYPES, other keys are refused rather than set as strings
+def configFromEnvironment(environ=os.environ):
+    config = {}
+    for key, default in app.config.items():
+        value = environ.get(f"COZYQUIZ_{key}")
+        if value is None:
+            continue
+        kind = CONFIG_TYPES.get(key)
+        if kind is None and isinstance(default, (bool, int, float, str)):
+            kind = type(default)
+        if kind is None:
+            raise RuntimeError(f"COZYQUIZ_{key} cannot be set from the environment")
+        if kind is bool:
+            config[key] = value.strip().lower() in ('1', 'true', 'yes')
+        else:
+            config[key] = kind(value)
+    return config
+
+
+# caches and the hashing pool are sized from the config, so they are built again whenever it changes.
+# The caches only hold data checked against a version read from MongoDB, so every worker process can
+# keep its own without serving stale pages
+def buildState():
+    global questionCache, fragmentCache, scoreCache, passwordHasher, liveStreamSlots
+    questionCache = LRUCache(app.config['QUESTION_CACHE_SIZE'], app.config['QUESTION_CACHE_TTL'])
+    fragmentCache = LRUCache(app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+    scoreCache = LRUCache(app.config['SCORE_CACHE_SIZE'], app.config['SCORE_CACHE_TTL'])
+    passwordHasher = passwords.PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+                                              app.config['PASSWORD_HASH_QUEUE'])
+    liveStreamSlots = BoundedSemaphore(app.config['LIVE_FEED_MAX_STREAMS'])
+
+
+app.config.from_mapping(configFromEnvironment())
+buildState()
+
+
+# raises passwords.TryAgainLater when the username or address failed too often or the hashing queue is full,
+# throttled attempts are refused before any hashing is done
 def checkPassword(username, password):
-    user = db.users.find_one({"username": username})
-    if user:
-        if check_password_hash(user['password'], password):
-            session['logged'] = f"{user['_id']}"
-            return True
+    userKey = f"user:{username}"
+    ipKey = f"ip:{request.remote_addr}"
+    if repository.countLoginFailures(userKey) >= app.config['LOGIN_MAX_FAILURES'] or \
+            repository.countLoginFailures(ipKey) >= app.config['LOGIN_MAX_FAILURES_PER_IP']:
+        raise passwords.TryAgainLater('Too many failed logins, try again later')
+    user = repository.findUserByUsername(username)
+    if user and passwordHasher.check(user['password'], password):
+        repository.resetLoginFailures(userKey)
+        if passwordHasher.needsRehash(user['password']):
+            try:
+                repository.updateUserPassword(username, passwordHasher.hash(password))
+            except passwords.TryAgainLater:
+                pass # the old hash still works, it is replaced on a later login
+        session['logged'] = f"{user['_id']}"
+        rememberIdentity(user)
+        return True
+    repository.recordLoginFailure(userKey, app.config['LOGIN_FAILURE_WINDOW'])
+    repository.recordLoginFailure(ipKey, app.config['LOGIN_FAILURE_WINDOW'])
     return False
 
 
+# username and profile pic live in the signed session cookie, so a logged page view
+# only reads the users collection again once the identity is older than IDENTITY_TTL
+def rememberIdentity(user):
+    session['identity'] = {'username': user['username'], 'profilePic': user['profile_pic'],
+                           'expires': time.time() + app.config['IDENTITY_TTL']}
+
+
+def forgetIdentity():
+    session.pop('identity', None)
+
+
+def getIdentity():
+    if 'logged' not in session:
+        return None
+    identity = session.get('identity')
+    if identity is None or identity['expires'] < time.time():
+        user = repository.findUserById(session['logged'])
+        if user is None:
+            session.pop('logged', None)
+            forgetIdentity()
+            return None
+        rememberIdentity(user)
+        identity = session['identity']
+    return identity
+
+
 def getLoggedUsername():
-    if 'logged' in session:
-        user = findUserById(session['logged'])
-        if user:
-            return user['username']
-        session.pop('logged', None)
+    identity = getIdentity()
+    if identity:
+        return identity['username']
     return ''
 
 
-def findUserById(id):
-    return db.users.find_one(ObjectId(id))
+def getProfilePic(size=125):
+    identity = getIdentity()
+    if identity:
+        if identity['profilePic'] != '':
+            return url_for('uploadedFile', filename=profilePicFilename(identity['profilePic'], size))
+    return 'static/icon.png'
 
 
-def getProfilePic():
-    user = db.users.find_one(ObjectId(session['logged']))
-    if user:
-        if user['profile_pic'] != '':
-            return url_for('uploadedFile', filename=user['profile_pic'])
-    return 'static/icon.png'
+# resized pics are stored as <hash>-<size>.jpg and the user only keeps the hash,
+# older uploads and the ones saved without Pillow keep their full filename
+def profilePicFilename(profilePic, size):
+    if '.' in profilePic:
+        return profilePic
+    for thumbnailSize in PROFILE_PIC_SIZES:
+        if thumbnailSize >= size:
+            return f"{profilePic}-{thumbnailSize}.jpg"
+    return f"{profilePic}-{PROFILE_PIC_SIZES[-1]}.jpg"
+
+
+# returns what to store in the user's profile_pic, or None when the upload is not an image
+def saveProfilePic(data, extension):
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    if Image is None:
+        filename = f"{digest}.{extension}"
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'wb') as picture:
+            picture.write(data)
+        return filename
+    try:
+        image = Image.open(io.BytesIO(data))
+        # open only reads the header, a small file can still claim a huge size and decode into gigabytes
+        width, height = image.size
+        if width * height > app.config['PROFILE_PIC_MAX_PIXELS']:
+            return None
+        # JPEGs are decoded straight at a reduced scale when the largest thumbnail allows it
+        image.draft('RGB', (PROFILE_PIC_SIZES[-1], PROFILE_PIC_SIZES[-1]))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return None
+    for size in PROFILE_PIC_SIZES:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], f"{digest}-{size}.jpg")
+        if not os.path.exists(path):
+            ImageOps.fit(image, (size, size)).save(path, 'JPEG', quality=85, optimize=True)
+    return digest
 
 
 def getCorrectOrWrong(i, keys):
@@ -60,27 +233,397 @@ def getCorrectOrWrong(i, keys):
 def allowedFile(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def getNextQuestion(room_id):
-    questions = list(db.questions.find({"roomId": ObjectId(room_id)}))
-    results = db.results.find_one({"roomId": ObjectId(room_id), "user": session['nickname']})
-    if results:
-        print('results[answers]: ', results['answers'])
-        question_id = results['answers'][-1]['questionId']
-        for i in range(len(questions)):
-            if questions[i]['_id'] == ObjectId(question_id):
-                if i + 1 < len(questions):
-                    return questions[i + 1]
+# ordered questions of a room, cached per process and dropped whenever the room's questionsVersion changes
+def getRoomQuestions(room):
+    room_id = str(room['_id'])
+    version = room.get('questionsVersion', 0)
+    roomQuestions = questionCache.get(room_id, version)
+    if roomQuestions is None:
+        questions = repository.findRoomQuestions(room['_id'])
+        roomQuestions = {'questions': questions, 'ids': [question['_id'] for question in questions],
+                         'byId': {question['_id']: question for question in questions},
+                         'answerKey': grading.compileAnswerKey(questions)}
+        questionCache.set(room_id, roomQuestions, version)
+    return roomQuestions
+
+def questionsChanged(room_id):
+    repository.incrementQuestionsVersion(room_id)
+    questionCache.invalidate(str(room_id))
+
+# html that only depends on the room's questions is rendered once per questionsVersion
+def renderFragment(version, key, template, **context):
+    html = fragmentCache.get(key, version)
+    if html is None:
+        html = Markup(render_template(template, **context))
+        fragmentCache.set(key, html, version)
+    return html
+
+# pages built from versioned data get an ETag from those versions, a matching
+# If-None-Match is answered with 304 before anything is rendered. Pages with pending
+# flash messages are always rendered because the messages are part of them
+def conditionalPage(versions, render):
+    if '_flashes' in session:
+        return render()
+    etag = hashlib.sha1(repr(versions + ('logged' in session,)).encode()).hexdigest()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# the result document keeps a cursor with the last answered question id, questions are served in _id order.
+# With deliver the question is stamped as served the first time it is returned, see recordAnswer
+def getNextQuestion(room, deliver=False):
+    roomQuestions = getRoomQuestions(room)
+    cursor, delivered = repository.findResultProgress(room['_id'], session['nickname'])
+    position = 0
+    if cursor is not None:
+        position = bisect_right(roomQuestions['ids'], cursor)
+    if position == len(roomQuestions['questions']):
         return None
-    return questions[0]
-
-def checkAnswer(question, answerNumber):
-    print('answerNumber', answerNumber)
-    print('question: ', question)
-    print('answer[0]: ', question['answers'][0])
-    print('answer[0][correct]: ', question['answers'][0]['correct'])
-    if question['answers'][answerNumber]['correct'] == True:
-        return True
-    return False
+    question = roomQuestions['questions'][position]
+    if deliver:
+        if delivered is None or delivered['questionId'] != question['_id']:
+            delivered = {'questionId': question['_id'], 'at': time.time()}
+            repository.markDelivered(room['_id'], session['nickname'], question['_id'], delivered['at'])
+        rememberDelivered(delivered)
+    return question
+
+def isValidAnswer(room, question, answerNumber):
+    return getRoomQuestions(room)['answerKey'][question['_id']].isValid(answerNumber)
+
+# answers are timed on the server from the moment the question was served. The wall clock is used
+# because the worker that serves a question is not necessarily the one that gets its answer. The stamp
+# stored with the result is also kept in the signed session, so an answer does not have to read it back;
+# the session only ever holds the stamp the database has, so an older cookie cannot earn a later one
+def rememberDelivered(delivered):
+    stamp = {'questionId': str(delivered['questionId']), 'at': delivered['at']}
+    if session.get('delivered') != stamp:
+        session['delivered'] = stamp
+
+def findDelivered(room, question):
+    stamp = session.get('delivered')
+    if stamp is not None and stamp['questionId'] == str(question['_id']):
+        return stamp['at']
+    delivered = repository.findDelivered(room['_id'], session['nickname'])
+    if delivered is not None and delivered['questionId'] == question['_id']:
+        return delivered['at']
+    return None
+
+class QuestionNotServed(Exception):
+    pass
+
+# returns False when the player already answered that question. Questions are answered in the order they
+# are served, an answer to any other question than the one last served raises QuestionNotServed
+def recordAnswer(room, question, answerNumber):
+    answeredAt = time.time()
+    deliveredAt = findDelivered(room, question)
+    if deliveredAt is None:
+        raise QuestionNotServed('That is not your current question')
+    elapsed = max(answeredAt - deliveredAt, 0)
+    answer = {'questionId': question['_id'], 'answerNumber': answerNumber,
+              'correct': checkAnswer(room, question, answerNumber), 'answeredAt': answeredAt,
+              'deliveredAt': deliveredAt}
+    questionKey = getRoomQuestions(room)['answerKey'][question['_id']]
+    answer['points'] = grading.answerPoints(answer['correct'], elapsed, questionKey.timeLimit,
+                                            app.config['QUESTION_POINTS'], app.config['ANSWER_TIME_GRACE'])
+    if not repository.pushAnswer(room['_id'], session['nickname'], answer, answer['points']):
+        return False
+    repository.incrementAnswerCount(room['_id'], question['_id'], answerNumber, grading.timeBucket(elapsed))
+    notifyRoomFeed(str(room['_id']))
+    return True
+
+# what a player gets to see of a question, the correct flags stay on the server
+def questionMessage(question):
+    answers = [{'number': answer['number'], 'text': answer['text'], 'bgColor': answer['bgColor'],
+                'textColor': answer['textColor']} for answer in question['answers']]
+    return {'_id': str(question['_id']), 'text': question['text'], 'timeLimit': question.get('timeLimit'),
+            'answers': answers}
+
+# owners listening to a room's live results wait on its condition until its sequence number moves,
+# every recorded answer bumps it. A room only has a feed while someone is listening to it
+roomFeeds = {}
+roomFeedsLock = Lock()
+
+def openRoomFeed(room_id):
+    with roomFeedsLock:
+        feed = roomFeeds.setdefault(room_id, {'condition': Condition(), 'sequence': 0, 'listeners': 0})
+        feed['listeners'] += 1
+        return feed
+
+def closeRoomFeed(room_id, feed):
+    with roomFeedsLock:
+        feed['listeners'] -= 1
+        if feed['listeners'] == 0 and roomFeeds.get(room_id) is feed:
+            del roomFeeds[room_id]
+
+def notifyRoomFeed(room_id):
+    with roomFeedsLock:
+        feed = roomFeeds.get(room_id)
+    if feed is None:
+        return
+    with feed['condition']:
+        feed['sequence'] += 1
+        feed['condition'].notify_all()
+
+def checkAnswer(room, question, answerNumber):
+    app.logger.debug('checking answer %s of question %s', answerNumber, question['_id'])
+    return getRoomQuestions(room)['answerKey'][question['_id']].isCorrect(answerNumber)
+
+def countAnswers(room_id):
+    return repository.ANSWER_COUNTERS[app.config['ANSWER_COUNTER']](room_id)
+
+# per-room answer counters, kept up to date with $inc every time an answer is recorded
+def getRoomAnswerCounts(room_id):
+    return parseAnswerCounts(repository.findRoomStats(room_id)['counts'])
+
+def parseAnswerCounts(stats):
+    counts = {}
+    for questionId, answers in stats.items():
+        for answerNumber, count in answers.items():
+            counts[(ObjectId(questionId), int(answerNumber))] = count
+    return counts
+
+# 1 + the players with a strictly higher score, so tied players share a rank
+def getLeaderboard(room_id, limit):
+    leaders = repository.findLeaders(room_id, limit)
+    for i, leader in enumerate(leaders):
+        leader['score'] = leader.get('score', 0)
+        if i > 0 and leader['score'] == leaders[i - 1]['score']:
+            leader['rank'] = leaders[i - 1]['rank']
+        else:
+            leader['rank'] = i + 1
+    return leaders
+
+# ascending scores of a room, cached per process for each roomStats version. Every recorded answer moves the
+# version after its score is written, so a list cached under a version holds at least the scores up to it.
+# Ranks are then a bisect instead of counting every higher score
+def getRoomScores(room_id):
+    room_id = str(room_id)
+    version = repository.findRoomStatsVersion(room_id)
+    scores = scoreCache.get(room_id, version)
+    if scores is None:
+        scores = repository.findScores(room_id)
+        scoreCache.set(room_id, scores, version)
+    return scores
+
+def getRank(room_id, user):
+    score = repository.findScore(room_id, user)
+    if score is None:
+        return None
+    scores = getRoomScores(room_id)
+    return {'user': user, 'score': score, 'rank': len(scores) - bisect_right(scores, score) + 1, 'players': len(scores)}
+
+def formatSeconds(seconds):
+    if seconds is None:
+        return f"over {grading.ANSWER_TIME_BUCKETS[-1]} s"
+    return f"{seconds:.1f} s"
+
+def roomResultsTemplate(questions, stats):
+    answerCounts = parseAnswerCounts(stats['counts'])
+    questionsTemplate = []
+    for question in questions:
+        answerTimes = None
+        if stats['latency'].get(str(question['_id'])):
+            answerTimes = [formatSeconds(seconds) for seconds in
+                           grading.timePercentiles(stats['latency'][str(question['_id'])], (0.5, 0.9, 0.99))]
+        answers = []
+        for questionAnswer in question['answers']:
+            answerCount = answerCounts.get((question['_id'], questionAnswer['number']), 0)
+            answers.append({'text': questionAnswer['text'], 'bgColor': questionAnswer['bgColor'],
+             'textColor': questionAnswer['textColor'], 'check': questionAnswer['correct'], "chooseBy": answerCount,
+             'number': questionAnswer['number']})
+        questionsTemplate.append({'questionId': question['_id'], 'question': question['text'], 'answers': answers,
+                                  'timeLimit': question.get('timeLimit'), 'answerTimes': answerTimes})
+    return questionsTemplate
+
+def rebuildRoomStats(room_id):
+    counts = {}
+    for (questionId, answerNumber), count in countAnswers(room_id).items():
+        counts.setdefault(str(questionId), {})[str(answerNumber)] = count
+    latency = {}
+    scores = []
+    for result in repository.iterResults(room_id):
+        score = 0
+        for answer in result['answers']:
+            # answers recorded before points existed are worth QUESTION_POINTS when correct
+            score += answer.get('points', app.config['QUESTION_POINTS'] if answer['correct'] else 0)
+            if 'deliveredAt' in answer:
+                buckets = latency.setdefault(str(answer['questionId']), {})
+                bucket = str(grading.timeBucket(max(answer['answeredAt'] - answer['deliveredAt'], 0)))
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+        scores.append((result['_id'], score))
+    # scores first, setting the counters moves the version that the cached score lists are checked against
+    repository.setScores(scores)
+    repository.setRoomStatsCounts(room_id, counts, latency)
+
+@app.cli.command('rebuild-stats')
+@click.argument('room_ids', nargs=-1)
+def rebuildStatsCommand(room_ids):
+    """Regenerate the answer counters, answer times and scores of the given rooms (all rooms by default) from db.results."""
+    if not room_ids:
+        room_ids = repository.findResultRoomIds()
+    for room_id in room_ids:
+        rebuildRoomStats(room_id)
+        click.echo(f"rebuilt stats for room {room_id}")
+
+@app.cli.command('migrate-members')
+def migrateMembersCommand():
+    """Move the joined array of older rooms into db.members and recount their joinedCount."""
+    for room_id in repository.migrateMembers():
+        click.echo(f"migrated members of room {room_id}")
+
+def bulkFormat(filename):
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension in ('jsonl', 'ndjson'):
+        return 'jsonl'
+    if extension == 'csv':
+        return 'csv'
+    return None
+
+def importQuestionBank(room_id, fileFormat, lines):
+    try:
+        return bulk.importQuestions(bulk.PARSERS[fileFormat](lines),
+                                    lambda questions: repository.insertQuestions(room_id, questions),
+                                    app.config['IMPORT_BATCH_SIZE'])
+    finally:
+        questionsChanged(room_id)
+
+def exportResponse(lines, filename, fileFormat):
+    return Response(lines, mimetype=bulk.MIMETYPES[fileFormat],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.cli.command('import-questions')
+@click.argument('room_id')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def importQuestionsCommand(room_id, path):
+    """Import a JSON Lines or CSV question bank into a room."""
+    if repository.findRoom(room_id) is None:
+        raise click.ClickException('Room not found')
+    fileFormat = bulkFormat(path)
+    if fileFormat is None:
+        raise click.ClickException('Questions can be imported from .jsonl or .csv files')
+    with open(path, encoding='utf-8', newline='') as lines:
+        imported, errors = importQuestionBank(room_id, fileFormat, lines)
+    for line, message in errors:
+        click.echo(f"line {line}: {message}", err=True)
+    click.echo(f"imported {imported} questions")
+
+@app.cli.command('export-questions')
+@click.argument('room_id')
+@click.option('--format', 'fileFormat', type=click.Choice(list(bulk.QUESTION_EXPORTERS)), default='jsonl')
+@click.option('--output', type=click.File('w'), default='-')
+def exportQuestionsCommand(room_id, fileFormat, output):
+    """Stream the questions of a room as JSON Lines or CSV."""
+    for line in bulk.QUESTION_EXPORTERS[fileFormat](repository.iterRoomQuestions(room_id)):
+        output.write(line)
+
+@app.cli.command('export-results')
+@click.argument('room_id')
+@click.option('--format', 'fileFormat', type=click.Choice(list(bulk.RESULT_EXPORTERS)), default='jsonl')
+@click.option('--output', type=click.File('w'), default='-')
+def exportResultsCommand(room_id, fileFormat, output):
+    """Stream the results of a room as JSON Lines or CSV."""
+    for line in bulk.RESULT_EXPORTERS[fileFormat](repository.iterResults(room_id)):
+        output.write(line)
+
+@app.cli.command('create-indexes')
+def createIndexesCommand():
+    """Create the indexes used by the routes, existing ones are left untouched."""
+    failures = repository.ensureIndexes()
+    for collection in repository.INDEXES:
+        click.echo(f"{collection}: {', '.join(repository.listIndexes(collection))}")
+    for collection, keys, unique, error in failures:
+        click.echo(indexFailureMessage(collection, keys, error), err=True)
+    if failures:
+        raise SystemExit(1)
+
+@app.cli.command('explain-queries')
+def explainQueriesCommand():
+    """Run explain() on every query shape the routes use and flag collection scans."""
+    collscans = 0
+    for plan in repository.explainQueries():
+        status = 'COLLSCAN' if plan['collscan'] else 'ok'
+        click.echo(f"{status:>8}  {plan['collection']}.{','.join(plan['query'])}  {' > '.join(plan['stages'])}")
+        collscans += plan['collscan']
+    if collscans:
+        raise SystemExit(1)
+
+@app.before_request
+def startMetrics():
+    metrics.startRequest()
+
+@app.after_request
+def recordMetrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.finishRequest(route, request.method)
+    if time.monotonic() - metricsFlushedAt >= app.config['METRICS_FLUSH_INTERVAL']:
+        flushMetrics()
+    return response
+
+# every worker process adds what it measured to the totals in MongoDB at most every METRICS_FLUSH_INTERVAL,
+# so a scrape answered by any worker sees the same counters. One thread flushes at a time, the others go on
+metricsFlushedAt = 0
+metricsFlushLock = Lock()
+
+def flushMetrics():
+    global metricsFlushedAt
+    if not metricsFlushLock.acquire(blocking=False):
+        return
+    try:
+        hits, misses = questionCache.takeCounts()
+        metrics.questionCacheHits.inc(hits)
+        metrics.questionCacheMisses.inc(misses)
+        hits, misses = fragmentCache.takeCounts()
+        metrics.fragmentCacheHits.inc(hits)
+        metrics.fragmentCacheMisses.inc(misses)
+        hits, misses = scoreCache.takeCounts()
+        metrics.scoreCacheHits.inc(hits)
+        metrics.scoreCacheMisses.inc(misses)
+        repository.incrementMetrics(metrics.drain())
+        metricsFlushedAt = time.monotonic()
+    finally:
+        metricsFlushLock.release()
+
+# indexes are created once at startup by create_app, when running index.py and by flask create-indexes.
+# The unique indexes are what rejects a second result, member or user with the same key, so the app does not
+# start without them. An index that is only there for speed is reported and the queries using it scan instead
+def indexFailureMessage(collection, keys, error):
+    fields = ', '.join(field for field, direction in keys)
+    if error.code == 11000:
+        return (f"{collection}: the unique index on {fields} was not created because some documents share the same "
+                f"{fields}, remove the duplicates and run flask create-indexes ({error})")
+    return f"{collection}: the index on {fields} was not created: {error}"
+
+def createIndexes():
+    missingUnique = []
+    for collection, keys, unique, error in repository.ensureIndexes():
+        if unique:
+            missingUnique.append(indexFailureMessage(collection, keys, error))
+        else:
+            app.logger.error(indexFailureMessage(collection, keys, error))
+    if missingUnique:
+        raise RuntimeError('cannot start without the unique indexes: ' + '; '.join(missingUnique))
+
+@app.route('/metrics')
+def showMetrics():
+    flushMetrics()
+    return Response(metrics.render(repository.findMetrics()), mimetype='text/plain; version=0.0.4')
+
+# hits and misses are the totals of all workers, the sizes belong to the worker that answers
+@app.route('/cache/stats')
+def showCacheStats():
+    flushMetrics()
+    totals = {series['name']: series.get('value', 0) for series in repository.findMetrics()}
+    caches = {}
+    for name, cache, hits, misses in (('questions', questionCache, metrics.questionCacheHits, metrics.questionCacheMisses),
+                                      ('fragments', fragmentCache, metrics.fragmentCacheHits, metrics.fragmentCacheMisses),
+                                      ('scores', scoreCache, metrics.scoreCacheHits, metrics.scoreCacheMisses)):
+        caches[name] = dict(cache.stats(), hits=totals.get(hits.name, 0), misses=totals.get(misses.name, 0))
+    return dict(caches, worker=os.getpid())
 
 @app.route('/')
 def home():
@@ -98,25 +641,18 @@ def enterQuiz():
         username = request.form.get("username")
         room_id = request.form.get("room_code") #room id is the same with room code
         # check if room exists
-        if ObjectId.is_valid(room_id):
-            room = db.rooms.find_one({"_id": ObjectId(room_id)})
-        else:
-             room = None
+        room = repository.findRoom(room_id)
         if room == None:
             flash("Unable to join, Room does not exist!", 'danger')
             return redirect(request.url)
         else:
-            # check if nickname exists in the same room
-            joined = room['joined']
-            if username in joined:
+            # the nickname is taken when it is already a member of the room (or in the joined array of an older room)
+            if username in room.get('joined', ()) or not repository.joinRoom(room_id, username):
                 flash("Nickname already Taken! :(", 'danger')
                 return redirect(request.url)
             else:
                 # add nickname to session
                 session['nickname'] = username
-                # add nickname to the room
-                db.rooms.update_one({"_id": ObjectId(room_id)}, {
-                                "$set": {"joined": joined + [username]}}) # adds user into joinedUsers array
         return redirect(url_for('answerQuiz', room_id=room_id))
 
 @app.route('/login', methods=["GET", "POST"])
@@ -130,8 +666,12 @@ def login():
     else:
         username = request.form.get("username")
         password = request.form.get("password")
-        if checkPassword(username, password):
-            return redirect(url_for('myProfile'))
+        try:
+            if checkPassword(username, password):
+                return redirect(url_for('myProfile'))
+        except passwords.TryAgainLater as error:
+            flash(str(error), 'danger')
+            return redirect(request.url)
         flash('Login Error', 'danger')
         return redirect(request.url)
 
@@ -146,14 +686,20 @@ def signup():
         if username == '':
             flash('Invalid Username', 'danger')
             return redirect(request.url)
-        if db.users.find_one({"username": username}) is not None:
+        if repository.findUserByUsername(username) is not None:
             flash('That Username is taken!', 'danger')
             return redirect(request.url)
         if password == '':
             flash('Invalid Password', 'danger')
             return redirect(request.url)
-        db.users.insert_one({"username": username, "password": generate_password_hash(password),
-                             "profile_pic": ''})
+        try:
+            repository.insertUser(username, passwordHasher.hash(password))
+        except DuplicateKeyError:
+            flash('That Username is taken!', 'danger')
+            return redirect(request.url)
+        except passwords.TryAgainLater as error:
+            flash(str(error), 'danger')
+            return redirect(request.url)
         flash('Account Created!', 'success')
         return redirect(url_for('login'))
 
@@ -161,9 +707,8 @@ def signup():
 def showUserQuizzes():
     username = getLoggedUsername()
     if username != '':
-        quizzes = list(db.rooms.find({"owner" : username}))
-        for quiz in quizzes:
-            print(quiz['_id'])
+        quizzes = repository.findRoomsByOwner(username)
+        app.logger.debug('%s owns %d quizzes', username, len(quizzes))
         return render_template('userQuizzes.html', quizzes = quizzes) 
     return redirect(url_for('login'))       
 
@@ -178,8 +723,7 @@ def createQuizVerification():
 def createQuiz():
     username = getLoggedUsername()
     if username != '':
-        room_info = db.rooms.insert_one({"owner": username, "joined": []})
-        room_id = room_info.inserted_id
+        room_id = repository.insertRoom(username)
         session['room_id'] = str(room_id)
         return redirect(url_for('showRoom', room_id=room_id))
     return redirect(url_for('login'))
@@ -188,7 +732,8 @@ def createQuiz():
 def myProfile():
     username = getLoggedUsername()
     if username != '':
-        return render_template("myProfile.html", username=username, profilePic=getProfilePic())
+        return render_template("myProfile.html", username=username, profilePic=getProfilePic(125),
+                               profilePic2x=getProfilePic(250))
     return redirect(url_for('login'))
 
 
@@ -196,6 +741,7 @@ def myProfile():
 def logout():
     if 'logged' in session:
         session.pop('logged', None)
+    forgetIdentity()
     return redirect('/')
 
 
@@ -215,14 +761,18 @@ def changePassword():
         if newPassword == '':
             flash('Invalid New Password', 'danger')
             return redirect(request.url)
-        if checkPassword(username, oldPassword):
-            if oldPassword == newPassword:
-                flash('New Password must be different from Old Password', 'danger')
-                return redirect(request.url)
-            db.users.update_one({"username": username}, {
-                                "$set": {"password": generate_password_hash(newPassword)}})
-            flash('Password Changed', 'success')
-            return redirect(url_for('myProfile'))
+        try:
+            if checkPassword(username, oldPassword):
+                if oldPassword == newPassword:
+                    flash('New Password must be different from Old Password', 'danger')
+                    return redirect(request.url)
+                repository.updateUserPassword(username, passwordHasher.hash(newPassword))
+                forgetIdentity()
+                flash('Password Changed', 'success')
+                return redirect(url_for('myProfile'))
+        except passwords.TryAgainLater as error:
+            flash(str(error), 'danger')
+            return redirect(request.url)
         flash('Invalid Old Password', 'danger')
         return redirect(request.url)
 
@@ -234,11 +784,20 @@ def uploadProfilePic():
         flash('Please, login first', 'danger')
         return redirect(url_for('login'))
     if request.method == 'POST':
-        if 'file' not in request.files:
+        # refuse the body before it is spooled, the form fields around the picture get some room
+        limit = app.config['PROFILE_PIC_MAX_BYTES'] + 64 * 1024
+        if app.config['MAX_CONTENT_LENGTH'] is None or limit < app.config['MAX_CONTENT_LENGTH']:
+            request.max_content_length = limit
+        try:
+            files = request.files
+        except RequestEntityTooLarge:
+            flash('That picture is too big', 'danger')
+            return redirect(request.url)
+        if 'file' not in files:
             flash('No file part', 'danger')
             return redirect(request.url)
 
-        file = request.files['file']
+        file = files['file']
         if file.filename == '':
             flash('No selected file', 'danger')
             return redirect(request.url)
@@ -249,29 +808,46 @@ def uploadProfilePic():
 
         if file and allowedFile(file.filename):
             extension = file.filename.rsplit('.', 1)[1].lower()
-            filename = secure_filename(session['logged'] + '.' + extension)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            db.users.update_one({"username": username},
-                                {"$set": {"profile_pic": filename}})
+            data = file.read(app.config['PROFILE_PIC_MAX_BYTES'] + 1)
+            if len(data) > app.config['PROFILE_PIC_MAX_BYTES']:
+                flash('That picture is too big', 'danger')
+                return redirect(request.url)
+            profilePic = saveProfilePic(data, extension)
+            if profilePic is None:
+                flash('Invalid image', 'danger')
+                return redirect(request.url)
+            repository.updateUserProfilePic(username, profilePic)
+            forgetIdentity()
             flash('Your profile pic was successfully updated!', 'success')
             return redirect(url_for('myProfile'))
     return render_template("uploadPic.html")
 
 
+# send_from_directory already answers conditional requests with 304 from the ETag and Last-Modified
 @app.route('/uploads/<filename>')
 def uploadedFile(filename):
+    if CONTENT_HASHED_FILE.match(filename):
+        response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=app.config['PROFILE_PIC_MAX_AGE'])
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
 # show the room with the given id
 @app.route('/rooms/<room_id>')
 def showRoom(room_id):
-    room = db.rooms.find_one({"_id": ObjectId(room_id)})
+    room = repository.findRoom(room_id)
     if room is None:
         flash('Room not found', 'danger')
         return redirect(url_for('home'))
 
-    questions = db.questions.find({"roomId": ObjectId(room_id)})
-    return render_template("room.html", room=room, joinedUsers=len(room['joined']), questions=questions)
+    # older rooms that were not migrated yet still count the nicknames in their joined array
+    joinedUsers = room.get('joinedCount', 0) + len(room.get('joined', ()))
+    def render():
+        questions = renderFragment(room.get('questionsVersion', 0), ('room', room_id), 'partials/roomQuestions.html', room=room,
+                                   questions=getRoomQuestions(room)['questions'])
+        return render_template("room.html", room=room, joinedUsers=joinedUsers, questions=questions)
+    return conditionalPage(('room', room_id, room.get('questionsVersion', 0), joinedUsers), render)
 
 @app.route('/rooms/<string:room_id>/questions/new', methods=['POST', 'GET'])
 def newQuestion(room_id):
@@ -280,7 +856,7 @@ def newQuestion(room_id):
         flash('Please, login first', 'danger')
         return redirect(url_for('login'))
 
-    room = db.rooms.find_one({"_id": ObjectId(room_id)})
+    room = repository.findRoom(room_id)
     if room is None:
         flash('Room not found', 'danger')
         return redirect(url_for('home'))
@@ -290,7 +866,7 @@ def newQuestion(room_id):
         return redirect(url_for('home'))
 
     if request.method == 'GET':
-        questions = list(db.questions.find({"room_id": ObjectId(room_id)}))
+        questions = getRoomQuestions(room)['questions']
         return render_template('newQuestion.html', questions=questions, room_id=room_id)
     else:
         answers = request.form.getlist('answer')
@@ -298,13 +874,83 @@ def newQuestion(room_id):
         bgColors = request.form.getlist('answerBgColor')
         txtColors = request.form.getlist('answerTextColor')
         keys = request.form.keys()
+        try:
+            timeLimit = bulk.parseTimeLimit(request.form.get('timeLimit'))
+        except bulk.InvalidQuestion as error:
+            flash(str(error), 'danger')
+            return redirect(request.url)
         answerList = []
         for i in range(len(answers)):
             answerList.append({'number': i, 'text': answers[i], 'bgColor': bgColors[i], 'textColor': txtColors[i], 'correct': getCorrectOrWrong(i, keys)})
-        db.questions.insert_one({'roomId': ObjectId(room_id), 'text': question, 'answers': answerList})
+        repository.insertQuestion(room_id, question, answerList, timeLimit)
+        questionsChanged(room_id)
         flash("Quiz question added", "success")
         return redirect(url_for('showRoom', room_id=room_id))
 
+@app.route('/rooms/<string:room_id>/questions/import', methods=['POST'])
+def importRoomQuestions(room_id):
+    username = getLoggedUsername()
+    if username == '':
+        flash('Please, login first', 'danger')
+        return redirect(url_for('login'))
+
+    room = repository.findRoom(room_id)
+    if room is None:
+        flash('Room not found', 'danger')
+        return redirect(url_for('home'))
+
+    if room['owner'] != username:
+        flash('You are not the owner of that room', 'danger')
+        return redirect(url_for('home'))
+
+    try:
+        file = request.files.get('file')
+    except RequestEntityTooLarge:
+        flash('That file is too big', 'danger')
+        return redirect(url_for('showRoom', room_id=room_id))
+    if file is None or file.filename == '':
+        flash('No selected file', 'danger')
+        return redirect(url_for('showRoom', room_id=room_id))
+
+    fileFormat = bulkFormat(file.filename)
+    if fileFormat is None:
+        flash('Questions can be imported from .jsonl or .csv files', 'danger')
+        return redirect(url_for('showRoom', room_id=room_id))
+
+    try:
+        imported, errors = importQuestionBank(room_id, fileFormat, io.TextIOWrapper(file.stream, encoding='utf-8', newline=''))
+    except UnicodeDecodeError:
+        flash('The file must be UTF-8 encoded', 'danger')
+        return redirect(url_for('showRoom', room_id=room_id))
+    for line, message in errors[:5]:
+        flash(f"Line {line}: {message}", 'warning')
+    if len(errors) > 5:
+        flash("... and more invalid questions", 'warning')
+    flash(f"{imported} questions imported", 'success')
+    return redirect(url_for('showRoom', room_id=room_id))
+
+@app.route('/rooms/<string:room_id>/questions/export.<fileFormat>')
+def exportRoomQuestions(room_id, fileFormat):
+    username = getLoggedUsername()
+    if username == '':
+        flash('Please, login first', 'danger')
+        return redirect(url_for('login'))
+
+    room = repository.findRoom(room_id)
+    if room is None:
+        flash('Room not found', 'danger')
+        return redirect(url_for('home'))
+
+    if room['owner'] != username:
+        flash('You are not the owner of that room', 'danger')
+        return redirect(url_for('home'))
+
+    if fileFormat not in bulk.QUESTION_EXPORTERS:
+        flash('Questions can be exported as jsonl or csv', 'danger')
+        return redirect(url_for('showRoom', room_id=room_id))
+    return exportResponse(bulk.QUESTION_EXPORTERS[fileFormat](repository.iterRoomQuestions(room_id)),
+                          f"{room_id}-questions.{fileFormat}", fileFormat)
+
 @app.route('/rooms/<string:room_id>/questions/delete/<question_id>', methods=["POST"])
 def deleteQuestion(room_id, question_id):
     if request.method == "POST":
@@ -313,7 +959,7 @@ def deleteQuestion(room_id, question_id):
             flash('Please, login first', 'danger')
             return redirect(url_for('login'))
 
-        room = db.rooms.find_one({"_id": ObjectId(room_id)})
+        room = repository.findRoom(room_id)
         if room is None:
             flash('Room not found', 'danger')
             return redirect(url_for('home'))
@@ -321,7 +967,8 @@ def deleteQuestion(room_id, question_id):
             flash('You are not the owner of that room', 'danger')
             return redirect(url_for('home'))
 
-        if db.questions.delete_one({"_id": ObjectId(question_id)}):
+        if repository.deleteQuestion(room_id, question_id):
+            questionsChanged(room_id)
             flash("Question deleted", "success")
             return redirect(url_for('showRoom', room_id=room_id))
         flash('Question not found', 'danger')
@@ -333,73 +980,135 @@ def answerQuiz(room_id):
         flash('Please, join the room first', 'warning')
         return redirect(url_for('home'))
 
-    room = db.rooms.find_one({"_id": ObjectId(room_id)})
+    room = repository.findRoom(room_id)
     if room is None:
         flash('Room not found', 'danger')
         return redirect(url_for('home'))
 
     if request.method == 'GET':
-        if db.questions.find_one({"roomId": ObjectId(room_id)}) is None:
+        if getRoomQuestions(room)['questions'] == []:
             flash('No questions in this room', 'danger')
             return redirect(url_for('home'))
-        question = getNextQuestion(room_id)
+        question = getNextQuestion(room, deliver=True)
         if question is None:
             flash('You finished your quiz', 'success')
             return redirect(url_for('showResults', room_id=room_id))
-        return render_template('answerQuiz.html', question=question, room=room)
+        def render():
+            questionCard = renderFragment(room.get('questionsVersion', 0), ('question', question['_id']), 'partials/questionCard.html',
+                                          room=room, question=question)
+            return render_template('answerQuiz.html', questionCard=questionCard, room=room)
+        return conditionalPage(('answerQuiz', room_id, room.get('questionsVersion', 0), question['_id']), render)
     else:
         questionId = request.form.get('questionId')
-        question = db.questions.find_one({"_id": ObjectId(questionId)})
+        if not ObjectId.is_valid(questionId):
+            flash('Question not found', 'danger')
+            return redirect(url_for('answerQuiz', room_id=room_id))
+        question = getRoomQuestions(room)['byId'].get(ObjectId(questionId))
+        if question is None:
+            flash('Question not found', 'danger')
+            return redirect(url_for('answerQuiz', room_id=room_id))
         answerNumber = request.form.get('answerNumber', type=int)
-        result = db.results.find_one({"roomId": ObjectId(room_id), "user": session['nickname']})
-        if result is None:
-            db.results.insert_one({'roomId': ObjectId(room_id), 'user': session['nickname'],
-             'answers': [{'questionId': ObjectId(questionId), 'answerNumber': answerNumber,
-             'correct': checkAnswer(question, answerNumber)}]})
-        else:
-            newAnswersArray = result['answers'] + [{'questionId': ObjectId(questionId),
-                                'answerNumber': answerNumber,
-                                'correct': checkAnswer(question, answerNumber)}]
-            db.results.update_one({"roomId": ObjectId(room_id), "user": session['nickname']},
-                                {"$set": {"answers": newAnswersArray}})
+        if not isValidAnswer(room, question, answerNumber):
+            flash('Answer not found', 'danger')
+            return redirect(url_for('answerQuiz', room_id=room_id))
+        try:
+            if not recordAnswer(room, question, answerNumber):
+                flash('You already answered that question', 'warning')
+        except QuestionNotServed as error:
+            flash(str(error), 'warning')
         return redirect(url_for('answerQuiz', room_id=room_id))
 
+# answers sent as small JSON messages over the player's keep-alive connection,
+# the reply carries the next question so there is no redirect and no re-render
+@app.route('/answerQuiz/<string:room_id>/answer', methods=['POST'])
+def answerQuizMessage(room_id):
+    if 'nickname' not in session:
+        return {'error': 'Please, join the room first'}, 403
+
+    room = repository.findRoom(room_id)
+    if room is None:
+        return {'error': 'Room not found'}, 404
+
+    try:
+        message = request.get_json(silent=True) or {}
+    except RequestEntityTooLarge:
+        return {'error': 'Message too large'}, 413
+    questionId = message.get('questionId')
+    question = None
+    if ObjectId.is_valid(questionId):
+        question = getRoomQuestions(room)['byId'].get(ObjectId(questionId))
+    if question is None:
+        return {'error': 'Question not found'}, 404
+    answerNumber = message.get('answerNumber')
+    if not isValidAnswer(room, question, answerNumber):
+        return {'error': 'Answer not found'}, 400
+
+    try:
+        accepted = recordAnswer(room, question, answerNumber)
+    except QuestionNotServed as error:
+        return {'error': str(error)}, 409
+    nextQuestion = getNextQuestion(room, deliver=True)
+    if nextQuestion is not None:
+        nextQuestion = questionMessage(nextQuestion)
+    return {'accepted': accepted, 'question': nextQuestion,
+            'resultsUrl': url_for('showResults', room_id=room_id)}
+
 @app.route('/results/<string:room_id>')
 def showResults(room_id):
-    room = db.rooms.find_one({"_id": ObjectId(room_id)})
+    room = repository.findRoom(room_id)
     if room is None:
         session.pop('nickname', None)
         flash('Room not found', 'danger')
         return redirect(url_for('home'))
 
-    results = db.results.find_one({"roomId": ObjectId(room_id), "user": session['nickname']})
-    if results is None:
+    results = repository.findResult(room_id, session['nickname'])
+    if results is None or results['answers'] == []:
         flash('You have not answered any questions yet', 'danger')
         return redirect(url_for('home'))
     
-    questionCount = len(list(db.questions.find({"roomId": ObjectId(room_id)})))
-    if len(results['answers']) != questionCount:
+    # finished is decided like answerQuiz does, so the two pages never send the player back and forth
+    if getNextQuestion(room) is not None:
         flash('You have not answered all the questions yet', 'danger')
         return redirect(url_for('answerQuiz', room_id=room_id))
 
-    rightAnswers = 0
+    roomQuestions = getRoomQuestions(room)
+    questionCount = len(roomQuestions['questions'])
+
+    answerKey = roomQuestions['answerKey']
+    correctBits = grading.correctBits(answerKey, results['answers'])
     resultsTemplate = []
     for answer in results['answers']:
-        question = db.questions.find_one({"_id": ObjectId(answer['questionId'])})
-        answers = []
-        for questionAnswer in question['answers']:
-            if questionAnswer['correct']:
-                if questionAnswer['number'] == answer['answerNumber']:
-                    rightAnswers += 1
-                answers.append({'text': questionAnswer['text'], 'bgColor': questionAnswer['bgColor'], 'textColor': questionAnswer['textColor'], 'check': True})
-            elif questionAnswer['number'] == answer['answerNumber']:
-                answers.append({'text': questionAnswer['text'], 'bgColor': questionAnswer['bgColor'], 'textColor': questionAnswer['textColor'], 'check': False})
-            else:
-                answers.append({'text': questionAnswer['text'], 'bgColor': questionAnswer['bgColor'], 'textColor': questionAnswer['textColor'], 'check': None})
-        resultsTemplate.append({'question': question['text'], 'answers': answers})
+        questionKey = answerKey.get(answer['questionId'])
+        if questionKey is None:
+            continue
+        answers = questionKey.display
+        if not (correctBits >> questionKey.position) & 1:
+            answers = list(answers)
+            answers[answer['answerNumber']] = dict(answers[answer['answerNumber']], check=False)
+        resultsTemplate.append({'question': questionKey.text, 'answers': answers})
+
+    rightAnswers = grading.countBits(correctBits)
+    leaders = getLeaderboard(room_id, app.config['LEADERBOARD_SIZE'])
+    rank = getRank(room_id, session['nickname'])
+    score = [rightAnswers, questionCount]
+    return render_template('showResults.html', results=resultsTemplate, score=score, room=room, leaders=leaders,
+                           rank=rank)
 
-    score = [rightAnswers, len(list(db.questions.find({"roomId": ObjectId(room_id)})))]
-    return render_template('showResults.html', results=resultsTemplate, score=score, room=room)
+@app.route('/rooms/<string:room_id>/leaderboard')
+def showLeaderboard(room_id):
+    if repository.findRoom(room_id) is None:
+        return {'error': 'Room not found'}, 404
+    top = min(request.args.get('top', app.config['LEADERBOARD_SIZE'], type=int), 100)
+    return {'leaders': getLeaderboard(room_id, max(top, 1))}
+
+@app.route('/rooms/<string:room_id>/leaderboard/<nickname>')
+def showLeaderboardRank(room_id, nickname):
+    if repository.findRoom(room_id) is None:
+        return {'error': 'Room not found'}, 404
+    rank = getRank(room_id, nickname)
+    if rank is None:
+        return {'error': 'Player not found'}, 404
+    return rank
 
 @app.route('/rooms/<string:room_id>/results')
 def showRoomResults(room_id):
@@ -408,7 +1117,7 @@ def showRoomResults(room_id):
         flash('Please, login first', 'danger')
         return redirect(url_for('login'))
 
-    room = db.rooms.find_one({"_id": ObjectId(room_id)})
+    room = repository.findRoom(room_id)
     if room is None:
         flash('Room not found', 'danger')
         return redirect(url_for('home'))
@@ -417,32 +1126,106 @@ def showRoomResults(room_id):
         flash('You are not the owner of this room', 'danger')
         return redirect(url_for('home'))
 
-    results = db.results.find({"roomId": ObjectId(room_id)})
-    results = list(results)
-    if results == []:
+    stats = repository.findRoomStats(room_id)
+    if stats['counts'] == {}:
         flash('No results in this room', 'danger')
         return redirect(url_for('showRoom', room_id=room_id))
 
-    questions = db.questions.find({"roomId": ObjectId(room_id)})
-    if questions is None:
+    questions = getRoomQuestions(room)['questions']
+    if questions == []:
         flash('No questions in this room', 'danger')
         return redirect(url_for('home'))
 
-    questionsTemplate = []
-    for question in list(questions):
-        answers = []
-        for questionAnswer in question['answers']:
-            answerCount = 0
-            for result in results:
-                for answer in result['answers']:
-                    if answer['questionId'] == question['_id']:
-                        if answer['answerNumber'] == questionAnswer['number']:
-                            answerCount += 1
-            answers.append({'text': questionAnswer['text'], 'bgColor': questionAnswer['bgColor'],
-             'textColor': questionAnswer['textColor'], 'check': questionAnswer['correct'], "chooseBy": answerCount})
-        questionsTemplate.append({'question': question['text'], 'answers': answers})
+    def render():
+        return render_template('roomResults.html', results=roomResultsTemplate(questions, stats), room=room)
+    return conditionalPage(('roomResults', room_id, room.get('questionsVersion', 0), stats['version']), render)
+
+@app.route('/rooms/<string:room_id>/results/export.<fileFormat>')
+def exportRoomResults(room_id, fileFormat):
+    username = getLoggedUsername()
+    if username == '':
+        flash('Please, login first', 'danger')
+        return redirect(url_for('login'))
+
+    room = repository.findRoom(room_id)
+    if room is None:
+        flash('Room not found', 'danger')
+        return redirect(url_for('home'))
+
+    if room['owner'] != username:
+        flash('You are not the owner of this room', 'danger')
+        return redirect(url_for('home'))
+
+    if fileFormat not in bulk.RESULT_EXPORTERS:
+        flash('Results can be exported as jsonl or csv', 'danger')
+        return redirect(url_for('showRoom', room_id=room_id))
+    return exportResponse(bulk.RESULT_EXPORTERS[fileFormat](repository.iterResults(room_id)),
+                          f"{room_id}-results.{fileFormat}", fileFormat)
+
+# server-sent events with the room's answer counters, pushed whenever they change. A stream holds its
+# request thread while it is open, so a worker serves at most LIVE_FEED_MAX_STREAMS of them and answers 503
+# past that. Each stream ends after LIVE_FEED_DURATION and the retry line makes the browser reconnect
+@app.route('/rooms/<string:room_id>/results/stream')
+def streamRoomResults(room_id):
+    username = getLoggedUsername()
+    if username == '':
+        return {'error': 'Please, login first'}, 401
+
+    room = repository.findRoom(room_id)
+    if room is None:
+        return {'error': 'Room not found'}, 404
+
+    if room['owner'] != username:
+        return {'error': 'You are not the owner of this room'}, 403
+
+    if not liveStreamSlots.acquire(blocking=False):
+        return {'error': 'Too many live results open, try again in a moment'}, 503
+    slots = liveStreamSlots
+
+    def events():
+        feed = openRoomFeed(room_id)
+        condition = feed['condition']
+        deadline = time.monotonic() + app.config['LIVE_FEED_DURATION']
+        try:
+            yield f"retry: {int(app.config['LIVE_FEED_RETRY'] * 1000)}\n\n"
+            lastCounts = None
+            while time.monotonic() < deadline:
+                # the sequence is taken before the counters are read, so an answer recorded in between
+                # has already moved it and the wait below returns at once
+                with condition:
+                    sequence = feed['sequence']
+                counts = repository.findRoomStats(room_id)['counts']
+                if counts != lastCounts:
+                    lastCounts = counts
+                    yield f"data: {json.dumps(counts)}\n\n"
+                else:
+                    yield ": keepalive\n\n"
+                with condition:
+                    condition.wait_for(lambda: feed['sequence'] != sequence,
+                                       min(app.config['LIVE_FEED_TIMEOUT'], max(deadline - time.monotonic(), 0)))
+                time.sleep(app.config['LIVE_FEED_INTERVAL'])
+        finally:
+            closeRoomFeed(room_id, feed)
+
+    response = Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    # the server closes the response also when the client left before the stream started
+    response.call_on_close(slots.release)
+    return response
 
-    return render_template('roomResults.html', results=questionsTemplate, room=room)
+# WSGI entry point for production servers, e.g. gunicorn 'index:create_app()' or serve.py. It is not a factory:
+# the routes are registered on the module's one app, so it configures and returns that app and a second call
+# reconfigures the same app and its caches. config is applied over the environment. Worker processes call it
+# once after they are forked, so each opens its own MongoDB client
+def create_app(config=None):
+    app.config.from_mapping(configFromEnvironment())
+    if config:
+        app.config.from_mapping(config)
+    if app.config['SECRET_KEY'] == 'super secret key' and not app.config['TESTING']:
+        app.logger.warning('COZYQUIZ_SECRET_KEY is not set, sessions are signed with the development key')
+    buildState()
+    repository.connect()
+    createIndexes()
+    return app
 
 if __name__ == '__main__':
     # db.users.drop()
@@ -481,4 +1264,5 @@ if __name__ == '__main__':
     #      "answers": [{"number": 0, "text": "around 205", "bgColor": "#eeeeee", "textColor": "#212529", "correct": True},
     #                  {"number": 1, "text": "around 180", "bgColor": "#eeeeee", "textColor": "#212529", "correct": False}]})
 
+    createIndexes()
     app.run(host='localhost', port=5000, debug=True)
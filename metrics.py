@@ -0,0 +1,146 @@
+from pymongo import monitoring
+from threading import Lock, local
+import time
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COMMAND_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+# cumulative histogram in the Prometheus sense, one series per label tuple. A worker process only keeps
+# the observations it has not flushed yet, the totals of all workers live in the shared store
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = Lock()
+
+    def observe(self, labelValues, value):
+        with self.lock:
+            series = self.series.get(labelValues)
+            if series is None:
+                series = self.series[labelValues] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    # the unflushed observations as (name, labelValues, increments), the local series start over
+    def drain(self):
+        with self.lock:
+            series, self.series = self.series, {}
+        increments = []
+        for labelValues, values in series.items():
+            fields = {f"buckets.{i}": count for i, count in enumerate(values['buckets']) if count}
+            fields.update({'sum': values['sum'], 'count': values['count']})
+            increments.append((self.name, labelValues, fields))
+        return increments
+
+    # stored is the list of series documents of this histogram, with the fields drain() increments
+    def render(self, stored):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for series in sorted(stored, key=lambda series: series['labels']):
+            labels = ','.join(f'{label}="{value}"' for label, value in zip(self.labels, series['labels']))
+            buckets = series.get('buckets', {})
+            for i, bound in enumerate(self.buckets):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {buckets.get(str(i), 0)}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series.get("count", 0)}')
+            lines.append(f'{self.name}_sum{{{labels}}} {series.get("sum", 0)}')
+            lines.append(f'{self.name}_count{{{labels}}} {series.get("count", 0)}')
+        return lines
+
+
+# counter without labels, drained and stored like the histograms
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def drain(self):
+        with self.lock:
+            value, self.value = self.value, 0
+        return [(self.name, (), {'value': value})] if value else []
+
+    def render(self, stored):
+        value = sum(series.get('value', 0) for series in stored)
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {value}"]
+
+
+requestDuration = Histogram('cozyquiz_request_duration_seconds', 'Time spent handling a request.',
+                            ('route', 'method'), LATENCY_BUCKETS)
+requestMongoCommands = Histogram('cozyquiz_request_mongo_commands', 'MongoDB commands issued by a request.',
+                                 ('route', 'method'), COMMAND_COUNT_BUCKETS)
+requestMongoDuration = Histogram('cozyquiz_request_mongo_duration_seconds', 'Time a request spent in MongoDB commands.',
+                                 ('route', 'method'), LATENCY_BUCKETS)
+questionCacheHits = Counter('cozyquiz_question_cache_hits_total', 'Question cache hits.')
+questionCacheMisses = Counter('cozyquiz_question_cache_misses_total', 'Question cache misses.')
+fragmentCacheHits = Counter('cozyquiz_fragment_cache_hits_total', 'Fragment cache hits.')
+fragmentCacheMisses = Counter('cozyquiz_fragment_cache_misses_total', 'Fragment cache misses.')
+scoreCacheHits = Counter('cozyquiz_score_cache_hits_total', 'Room score cache hits.')
+scoreCacheMisses = Counter('cozyquiz_score_cache_misses_total', 'Room score cache misses.')
+METRICS = [requestDuration, requestMongoCommands, requestMongoDuration,
+           questionCacheHits, questionCacheMisses, fragmentCacheHits, fragmentCacheMisses, scoreCacheHits, scoreCacheMisses]
+
+# pymongo runs the listener on the thread that issued the command, which is the request's thread
+current = local()
+
+
+def startRequest():
+    current.started = time.perf_counter()
+    current.commands = 0
+    current.commandSeconds = 0.0
+
+
+def finishRequest(route, method):
+    if getattr(current, 'started', None) is None:
+        return
+    labels = (route, method)
+    requestDuration.observe(labels, time.perf_counter() - current.started)
+    requestMongoCommands.observe(labels, current.commands)
+    requestMongoDuration.observe(labels, current.commandSeconds)
+    current.started = None
+
+
+def recordCommand(seconds):
+    if getattr(current, 'started', None) is not None:
+        current.commands += 1
+        current.commandSeconds += seconds
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        recordCommand(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        recordCommand(event.duration_micros / 1e6)
+
+
+def drain():
+    increments = []
+    for metric in METRICS:
+        increments += metric.drain()
+    return increments
+
+
+# stored are the series documents of every metric in the shared store, extra samples are passed in
+# as (name, help, type, value) so other modules do not depend on this one
+def render(stored, samples=()):
+    lines = []
+    for metric in METRICS:
+        lines += metric.render([series for series in stored if series['name'] == metric.name])
+    for name, help, kind, value in samples:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return '\n'.join(lines) + '\n'
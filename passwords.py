@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class TryAgainLater(Exception):
+    pass
+
+
+# password hashes are computed on a fixed number of threads. A login occupies its request thread until
+# its hash is done, so at most workers + queueSize request threads can be busy with logins at once; keep
+# that below the threads of a server worker so the quiz routes always have threads left. A login that
+# finds every slot taken gives up right away instead of waiting for one
+class PasswordHasher:
+    def __init__(self, method='scrypt', workers=2, queueSize=2):
+        self.method = method
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+        self.slots = BoundedSemaphore(workers + queueSize)
+        # hashed once here, off the request path, so needsRehash never has to wait for a slot
+        self.storedMethod = generate_password_hash('', method).split('$', 1)[0]
+
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise TryAgainLater('Too many logins at once, try again in a moment')
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        return future.result()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def check(self, passwordHash, password):
+        return self.run(check_password_hash, passwordHash, password)
+
+    # hashes start with the method and its parameters as werkzeug writes them, e.g. scrypt:32768:8:1,
+    # a hash made with other parameters than the configured ones is replaced on the next login
+    def needsRehash(self, passwordHash):
+        return passwordHash.split('$', 1)[0] != self.storedMethod
@@ -0,0 +1,416 @@
+from pymongo import MongoClient, ReadPreference
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta, timezone
+import os
+
+
+# connection settings, all of them can be overridden from the environment
+MONGO_SETTINGS = {
+    'backend': os.environ.get('COZYQUIZ_MONGO_BACKEND', 'pymongo'), # 'pymongo' or 'mongomock' to run offline
+    'uri': os.environ.get('COZYQUIZ_MONGO_URI', 'mongodb://localhost:27017'),
+    'database': os.environ.get('COZYQUIZ_MONGO_DATABASE', 'cozyQuiz'),
+    'maxPoolSize': int(os.environ.get('COZYQUIZ_MONGO_MAX_POOL_SIZE', 100)),
+    'minPoolSize': int(os.environ.get('COZYQUIZ_MONGO_MIN_POOL_SIZE', 0)),
+    'connectTimeoutMS': int(os.environ.get('COZYQUIZ_MONGO_CONNECT_TIMEOUT_MS', 5000)),
+    'serverSelectionTimeoutMS': int(os.environ.get('COZYQUIZ_MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+    'socketTimeoutMS': int(os.environ.get('COZYQUIZ_MONGO_SOCKET_TIMEOUT_MS', 10000)),
+    'waitQueueTimeoutMS': int(os.environ.get('COZYQUIZ_MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+    'readPreference': os.environ.get('COZYQUIZ_MONGO_READ_PREFERENCE', 'primary'),
+}
+
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+
+POOL_OPTIONS = ['maxPoolSize', 'minPoolSize', 'connectTimeoutMS', 'serverSelectionTimeoutMS',
+                'socketTimeoutMS', 'waitQueueTimeoutMS']
+
+# pymongo command listeners given to every client, e.g. for metrics
+EVENT_LISTENERS = []
+
+client = None
+db = None
+
+
+# (re)creates the client, nothing is sent to the server until the first query
+def connect(**settings):
+    global client, db
+    MONGO_SETTINGS.update(settings)
+    if client is not None:
+        client.close()
+    if MONGO_SETTINGS['backend'] == 'mongomock':
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        options = {option: MONGO_SETTINGS[option] for option in POOL_OPTIONS}
+        client = MongoClient(MONGO_SETTINGS['uri'], read_preference=READ_PREFERENCES[MONGO_SETTINGS['readPreference']],
+                             event_listeners=EVENT_LISTENERS, **options)
+    db = client[MONGO_SETTINGS['database']]
+    return db
+
+
+def getDb():
+    if db is None:
+        connect()
+    return db
+
+
+# users
+
+def findUserById(user_id):
+    return getDb().users.find_one({"_id": ObjectId(user_id)})
+
+
+def findUserByUsername(username):
+    return getDb().users.find_one({"username": username})
+
+
+# raises DuplicateKeyError when the username is taken
+def insertUser(username, passwordHash):
+    return getDb().users.insert_one({"username": username, "password": passwordHash, "profile_pic": ''}).inserted_id
+
+
+def updateUserPassword(username, passwordHash):
+    getDb().users.update_one({"username": username}, {"$set": {"password": passwordHash}})
+
+
+def updateUserProfilePic(username, filename):
+    getDb().users.update_one({"username": username}, {"$set": {"profile_pic": filename}})
+
+
+# failed logins per key, kept here rather than in the app so every worker process sees the same counts.
+# A window starts with the first failure and the TTL index drops it once it expired
+def countLoginFailures(key):
+    failures = getDb().loginFailures.find_one({"_id": key, "expires": {"$gt": datetime.now(timezone.utc)}})
+    return failures['count'] if failures else 0
+
+
+def recordLoginFailure(key, window):
+    now = datetime.now(timezone.utc)
+    current = {"$gt": ["$expires", now]}
+    getDb().loginFailures.update_one({"_id": key}, [{"$set": {
+        "count": {"$cond": [current, {"$add": ["$count", 1]}, 1]},
+        "expires": {"$cond": [current, "$expires", now + timedelta(seconds=window)]},
+    }}], upsert=True)
+
+
+def resetLoginFailures(key):
+    getDb().loginFailures.delete_one({"_id": key})
+
+
+# metrics, one document per series with the totals of every worker process, increments come from
+# metrics.drain() as (name, labelValues, {field: amount})
+def incrementMetrics(increments):
+    for name, labels, fields in increments:
+        getDb().metrics.update_one({"_id": f"{name}{list(labels)}"},
+                                   {"$inc": fields, "$setOnInsert": {"name": name, "labels": list(labels)}}, upsert=True)
+
+
+# the whole collection is read, it holds a few documents per route
+def findMetrics():
+    return list(getDb().metrics.find())
+
+
+# rooms
+
+def findRoom(room_id):
+    if not ObjectId.is_valid(room_id):
+        return None
+    return getDb().rooms.find_one({"_id": ObjectId(room_id)})
+
+
+def findRoomsByOwner(owner):
+    return list(getDb().rooms.find({"owner": owner}))
+
+
+def insertRoom(owner):
+    return getDb().rooms.insert_one({"owner": owner, "joinedCount": 0}).inserted_id
+
+
+def incrementQuestionsVersion(room_id):
+    getDb().rooms.update_one({"_id": ObjectId(room_id)}, {"$inc": {"questionsVersion": 1}})
+
+
+# members, one document per nickname that joined a room. The unique (roomId, nickname) index
+# decides which of two racing joins gets the nickname, joinedCount on the room is kept next to it.
+# Rooms created before members existed keep their nicknames in a joined array until migrateMembers
+def joinRoom(room_id, nickname):
+    try:
+        getDb().members.insert_one({"roomId": ObjectId(room_id), "nickname": nickname})
+    except DuplicateKeyError:
+        return False
+    getDb().rooms.update_one({"_id": ObjectId(room_id)}, {"$inc": {"joinedCount": 1}})
+    return True
+
+
+def countMembers(room_id):
+    return getDb().members.count_documents({"roomId": ObjectId(room_id)})
+
+
+# moves the joined array of older rooms into members and recounts joinedCount, returns the migrated room ids
+def migrateMembers():
+    migrated = []
+    for room in getDb().rooms.find({"joined": {"$exists": True}}, {"joined": 1}):
+        members = [{"roomId": room['_id'], "nickname": nickname} for nickname in dict.fromkeys(room['joined'])]
+        if members:
+            try:
+                getDb().members.insert_many(members, ordered=False)
+            except BulkWriteError:
+                pass # nicknames that joined after the array stopped being written are already members
+        getDb().rooms.update_one({"_id": room['_id']},
+                                 {"$set": {"joinedCount": countMembers(room['_id'])}, "$unset": {"joined": ""}})
+        migrated.append(room['_id'])
+    return migrated
+
+
+
+# questions
+
+def findRoomQuestions(room_id):
+    return list(getDb().questions.find({"roomId": ObjectId(room_id)}, sort=[("_id", 1)]))
+
+
+# timeLimit is only stored on timed questions, in seconds
+def insertQuestion(room_id, text, answers, timeLimit=None):
+    question = {'roomId': ObjectId(room_id), 'text': text, 'answers': answers}
+    if timeLimit is not None:
+        question['timeLimit'] = timeLimit
+    return getDb().questions.insert_one(question).inserted_id
+
+
+def insertQuestions(room_id, questions):
+    documents = []
+    for question in questions:
+        document = {'roomId': ObjectId(room_id), 'text': question['text'], 'answers': question['answers']}
+        if question.get('timeLimit') is not None:
+            document['timeLimit'] = question['timeLimit']
+        documents.append(document)
+    getDb().questions.insert_many(documents)
+
+
+# cursors for streaming exports, documents are fetched batchSize at a time
+def iterRoomQuestions(room_id, batchSize=500):
+    return getDb().questions.find({"roomId": ObjectId(room_id)}, sort=[("_id", 1)], batch_size=batchSize)
+
+
+def deleteQuestion(room_id, question_id):
+    return getDb().questions.delete_one({"_id": ObjectId(question_id), "roomId": ObjectId(room_id)}).deleted_count > 0
+
+
+# results
+
+def findResult(room_id, user):
+    return getDb().results.find_one({"roomId": ObjectId(room_id), "user": user})
+
+
+# returns (cursor, delivered) of a player. cursor holds the last answered question id, results written
+# before it existed only have their last answer. delivered is the question last served and when
+def findResultProgress(room_id, user):
+    result = getDb().results.find_one({"roomId": ObjectId(room_id), "user": user},
+                                      {"cursor": 1, "delivered": 1, "answers": {"$slice": -1}})
+    if result is None:
+        return None, None
+    cursor = result.get('cursor')
+    if cursor is None and result['answers']:
+        cursor = result['answers'][-1]['questionId']
+    return cursor, result.get('delivered')
+
+
+# answers are timed from the delivery stamp. A player who was served a question but has not answered
+# yet has a result without a score, which keeps them off the leaderboard and out of the exports
+def markDelivered(room_id, user, questionId, at):
+    query = {"roomId": ObjectId(room_id), "user": user}
+    update = {"$set": {"delivered": {"questionId": questionId, "at": at}}}
+    try:
+        getDb().results.update_one(query, dict(update, **{"$setOnInsert": {"answers": []}}), upsert=True)
+    except DuplicateKeyError:
+        getDb().results.update_one(query, update)
+
+
+def findDelivered(room_id, user):
+    result = getDb().results.find_one({"roomId": ObjectId(room_id), "user": user}, {"delivered": 1})
+    if result:
+        return result.get('delivered')
+    return None
+
+
+# returns False when the answer was not recorded. Only the question last delivered to the player can be
+# answered, markDelivered created the result then, and the $ne filter makes a second submission a no-op,
+# also when two of them race. The score is kept next to the answers for the leaderboard
+def pushAnswer(room_id, user, answer, points):
+    recorded = getDb().results.update_one({"roomId": ObjectId(room_id), "user": user,
+                                           "delivered.questionId": answer['questionId'],
+                                           "answers.questionId": {"$ne": answer['questionId']}},
+                                          {"$push": {"answers": answer}, "$max": {"cursor": answer['questionId']},
+                                           "$inc": {"score": points}})
+    return recorded.modified_count > 0
+
+
+def iterResults(room_id, batchSize=500):
+    return getDb().results.find({"roomId": ObjectId(room_id), "answers.0": {"$exists": True}}, {"user": 1, "answers": 1},
+                                batch_size=batchSize)
+
+
+# scores is a list of (result _id, score)
+def setScores(scores):
+    for result_id, score in scores:
+        getDb().results.update_one({"_id": result_id}, {"$set": {"score": score}})
+
+
+# leaderboard, served from the descending (roomId, score, _id) index. Only results with a score count,
+# the first answer sets it, and score >= 0 keeps that an index range
+
+def findLeaders(room_id, limit):
+    return list(getDb().results.find({"roomId": ObjectId(room_id), "score": {"$gte": 0}}, {"_id": 0, "user": 1, "score": 1},
+                                     sort=[("score", -1), ("_id", 1)], limit=limit))
+
+
+def findScore(room_id, user):
+    result = getDb().results.find_one({"roomId": ObjectId(room_id), "user": user}, {"score": 1})
+    if result:
+        return result.get('score')
+    return None
+
+
+# every score of a room in ascending order, read from the (roomId, score) index alone
+def findScores(room_id):
+    scores = getDb().results.find({"roomId": ObjectId(room_id), "score": {"$gte": 0}}, {"_id": 0, "score": 1},
+                                  sort=[("score", 1)])
+    return [result['score'] for result in scores]
+
+
+def findResultRoomIds():
+    return getDb().results.distinct('roomId')
+
+
+# counts how many times each answer was picked in a room, keyed by (questionId, answerNumber)
+def countAnswersAggregate(room_id):
+    pipeline = [
+        {"$match": {"roomId": ObjectId(room_id)}},
+        {"$unwind": "$answers"},
+        {"$group": {"_id": {"questionId": "$answers.questionId", "answerNumber": "$answers.answerNumber"},
+                    "count": {"$sum": 1}}},
+    ]
+    counts = {}
+    for row in getDb().results.aggregate(pipeline):
+        counts[(row['_id']['questionId'], row['_id']['answerNumber'])] = row['count']
+    return counts
+
+
+def countAnswersLinear(room_id):
+    counts = {}
+    results = getDb().results.find({"roomId": ObjectId(room_id)}, {"answers.questionId": 1, "answers.answerNumber": 1})
+    for result in results:
+        for answer in result['answers']:
+            key = (answer['questionId'], answer['answerNumber'])
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+ANSWER_COUNTERS = {'aggregate': countAnswersAggregate, 'linear': countAnswersLinear}
+
+
+# room stats, the answer counters of a room are stored as counts.<questionId>.<answerNumber> and the
+# answer time histograms as latency.<questionId>.<bucket>, see grading.ANSWER_TIME_BUCKETS
+
+def incrementAnswerCount(room_id, questionId, answerNumber, timeBucket=None):
+    increments = {f"counts.{questionId}.{answerNumber}": 1, "version": 1}
+    if timeBucket is not None:
+        increments[f"latency.{questionId}.{timeBucket}"] = 1
+    getDb().roomStats.update_one({"roomId": ObjectId(room_id)}, {"$inc": increments}, upsert=True)
+
+
+# version goes up with every change to the counters, so it can tag anything rendered from them
+def findRoomStatsVersion(room_id):
+    stats = getDb().roomStats.find_one({"roomId": ObjectId(room_id)}, {"version": 1})
+    return stats.get('version', 0) if stats else 0
+
+
+def findRoomStats(room_id):
+    stats = getDb().roomStats.find_one({"roomId": ObjectId(room_id)}, {"counts": 1, "latency": 1, "version": 1})
+    if stats:
+        return {'counts': stats.get('counts', {}), 'latency': stats.get('latency', {}), 'version': stats.get('version', 0)}
+    return {'counts': {}, 'latency': {}, 'version': 0}
+
+
+def setRoomStatsCounts(room_id, counts, latency):
+    getDb().roomStats.update_one({"roomId": ObjectId(room_id)},
+                                 {"$set": {"counts": counts, "latency": latency}, "$inc": {"version": 1}}, upsert=True)
+
+
+# indexes, every query shape used by the routes has one and create_index is a no-op when it already
+# exists. pushAnswer relies on the unique (roomId, user) index to reject racing upserts and
+# joinRoom on the unique (roomId, nickname) one to reject racing joins
+INDEXES = {
+    'users': [([("username", 1)], {'unique': True})],
+    'rooms': [([("owner", 1)], {})],
+    'questions': [([("roomId", 1), ("_id", 1)], {})],
+    'results': [([("roomId", 1), ("user", 1)], {'unique': True}),
+                ([("roomId", 1), ("score", -1), ("_id", 1)], {})],
+    'roomStats': [([("roomId", 1)], {'unique': True})],
+    'members': [([("roomId", 1), ("nickname", 1)], {'unique': True})],
+    'loginFailures': [([("expires", 1)], {'expireAfterSeconds': 0})],
+}
+
+# (collection, filter, sort) of the queries issued above, with placeholder values
+QUERY_SHAPES = [
+    ('users', {"_id": ObjectId()}, None),
+    ('users', {"username": ''}, None),
+    ('rooms', {"_id": ObjectId()}, None),
+    ('rooms', {"owner": ''}, None),
+    ('questions', {"roomId": ObjectId()}, [("_id", 1)]),
+    ('results', {"roomId": ObjectId(), "user": ''}, None),
+    ('results', {"roomId": ObjectId()}, None),
+    ('results', {"roomId": ObjectId(), "score": {"$gte": 0}}, [("score", -1), ("_id", 1)]),
+    ('results', {"roomId": ObjectId(), "score": {"$gte": 0}}, [("score", 1)]),
+    ('roomStats', {"roomId": ObjectId()}, None),
+    ('members', {"roomId": ObjectId()}, None),
+    ('loginFailures', {"_id": '', "expires": {"$gt": datetime.now(timezone.utc)}}, None),
+]
+
+
+# returns (collection, keys, unique, error) for every index that could not be built, most often a unique index
+# over documents that already have duplicates. The others are still created
+def ensureIndexes():
+    failures = []
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                getDb()[collection].create_index(keys, **options)
+            except OperationFailure as error:
+                failures.append((collection, keys, options.get('unique', False), error))
+    return failures
+
+
+def listIndexes(collection):
+    return list(getDb()[collection].index_information())
+
+
+def findPlanStages(plan):
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages += findPlanStages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += findPlanStages(value)
+    return stages
+
+
+def explainQueries():
+    report = []
+    for collection, query, sort in QUERY_SHAPES:
+        cursor = getDb()[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = findPlanStages(cursor.explain()['queryPlanner']['winningPlan'])
+        report.append({'collection': collection, 'query': sorted(query), 'stages': stages,
+                       'collscan': 'COLLSCAN' in stages})
+    return report
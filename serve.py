@@ -0,0 +1,143 @@
+# Production launcher, runs the app in several worker processes listening on the same port.
+# Configuration comes from the environment (COZYQUIZ_<KEY> for app.config, COZYQUIZ_MONGO_* for the database).
+#
+#   COZYQUIZ_SECRET_KEY=... python serve.py --workers 4 --threads 8 --bind 0.0.0.0:8000
+#
+# gunicorn is used when it is installed, otherwise the workers are forked here and each one serves
+# the shared listening socket with werkzeug's server on a pool of --threads threads. Either way a worker
+# handles at most --threads requests at once, the app's PASSWORD_HASH_* and LIVE_FEED_MAX_STREAMS limits
+# are sized against that.
+import argparse
+import os
+import secrets
+import signal
+import socket
+import sys
+
+
+def parseBind(bind):
+    host, port = bind.rsplit(':', 1)
+    return host, int(port)
+
+
+def prepareEnvironment(workers):
+    # every worker has to sign sessions with the same key, otherwise a login is only valid on one of them
+    if 'COZYQUIZ_SECRET_KEY' not in os.environ:
+        os.environ['COZYQUIZ_SECRET_KEY'] = secrets.token_hex(32)
+        print('COZYQUIZ_SECRET_KEY is not set, using a random key: sessions end when the server restarts',
+              file=sys.stderr)
+    if workers > 1:
+        # live results streams are only woken up by answers recorded in their own worker
+        os.environ.setdefault('COZYQUIZ_LIVE_FEED_TIMEOUT', '1')
+        if os.environ.get('COZYQUIZ_MONGO_BACKEND') == 'mongomock':
+            print('mongomock keeps a separate database in every worker, use it with --workers 1',
+                  file=sys.stderr)
+
+
+def runGunicorn(bind, workers, threads):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', bind)
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+
+        def load(self):
+            from index import create_app
+            return create_app()
+
+    Application().run()
+
+
+# werkzeug's threaded server starts a thread per connection without limit, this one hands connections to a
+# fixed pool instead and the ones beyond it wait their turn. A connection that sends nothing for IDLE_TIMEOUT
+# seconds is closed, so idle keep-alive or stalled clients do not hold on to a thread
+IDLE_TIMEOUT = 5
+
+
+def makePooledServer(host, port, app, threads, fd):
+    from concurrent.futures import ThreadPoolExecutor
+    from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+    class RequestHandler(WSGIRequestHandler):
+        timeout = IDLE_TIMEOUT
+
+    class PooledWSGIServer(BaseWSGIServer):
+        multithread = True
+
+        def __init__(self):
+            super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+            self.pool = ThreadPoolExecutor(threads, thread_name_prefix='request')
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self.processRequestThread, request, client_address)
+
+        def processRequestThread(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    return PooledWSGIServer()
+
+
+def serveWorker(listener, host, port, threads):
+    from index import create_app
+    server = makePooledServer(host, port, create_app(), threads, listener.fileno())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def runBuiltin(bind, workers, threads):
+    host, port = parseBind(bind)
+    listener = socket.create_server((host, port), backlog=1024)
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            serveWorker(listener, host, port, threads)
+            os._exit(0)
+        children.append(pid)
+    print(f"serving on http://{host}:{port} with {workers} workers", file=sys.stderr)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run cozyQuiz with several worker processes')
+    parser.add_argument('--bind', default=os.environ.get('COZYQUIZ_BIND', '127.0.0.1:8000'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('COZYQUIZ_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('COZYQUIZ_THREADS', 8)))
+    parser.add_argument('--server', choices=['auto', 'gunicorn', 'builtin'], default='auto')
+    args = parser.parse_args()
+
+    prepareEnvironment(args.workers)
+    server = args.server
+    if server == 'auto':
+        try:
+            import gunicorn # noqa: F401
+            server = 'gunicorn'
+        except ImportError:
+            server = 'builtin'
+    if server == 'gunicorn':
+        runGunicorn(args.bind, args.workers, args.threads)
+    else:
+        runBuiltin(args.bind, args.workers, args.threads)
+
+
+if __name__ == '__main__':
+    main()
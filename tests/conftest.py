@@ -0,0 +1,54 @@
+import os
+import re
+
+import pytest
+
+# the app tests run against an in-memory mongomock database, a new one for every test
+os.environ.setdefault('COZYQUIZ_MONGO_BACKEND', 'mongomock')
+
+
+@pytest.fixture
+def app(tmp_path):
+    import index
+    return index.create_app({'TESTING': True, 'UPLOAD_FOLDER': str(tmp_path),
+                             'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000'})
+
+
+QUESTION_ID = re.compile(r'name="questionId" value="([0-9a-f]+)"')
+
+
+# servedQuestionId(client, room_id) loads the player's question page and returns the id of the question served
+@pytest.fixture
+def servedQuestionId():
+    def servedQuestionId(client, room_id):
+        return QUESTION_ID.search(client.get(f'/answerQuiz/{room_id}/').get_data(as_text=True)).group(1)
+    return servedQuestionId
+
+
+# makeRoom(questions, timeLimit) signs up an owner and returns the id of a new room whose questions have
+# two answers, the second one right
+@pytest.fixture
+def makeRoom(app):
+    def makeRoom(questions=1, timeLimit=None):
+        owner = app.test_client()
+        owner.post('/signup', data={'username': 'owner', 'password': 'pw'})
+        owner.post('/login', data={'username': 'owner', 'password': 'pw'})
+        room_id = owner.get('/createQuiz').headers['Location'].rsplit('/', 1)[1]
+        for i in range(questions):
+            question = {'questionText': f'question {i}', 'answer': ['a', 'b'], 'answerBgColor': ['#eeeeee'] * 2,
+                        'answerTextColor': ['#212529'] * 2, 'correct1': 'yes'}
+            if timeLimit is not None:
+                question['timeLimit'] = str(timeLimit)
+            owner.post(f'/rooms/{room_id}/questions/new', data=question)
+        return room_id
+    return makeRoom
+
+
+# player(room_id, nickname) returns a client that joined the room with that nickname
+@pytest.fixture
+def player(app):
+    def player(room_id, nickname):
+        client = app.test_client()
+        client.post('/enterQuiz', data={'username': nickname, 'room_code': room_id})
+        return client
+    return player
@@ -0,0 +1,64 @@
+from bson.objectid import ObjectId
+
+import repository
+
+
+def test_sameQuestionAnsweredTwiceIsRecordedOnce(app, makeRoom, player, servedQuestionId):
+    room_id = makeRoom(questions=2)
+    client = player(room_id, 'alice')
+    questionId = servedQuestionId(client, room_id)
+
+    client.post(f'/answerQuiz/{room_id}/', data={'questionId': questionId, 'answerNumber': '1'})
+    # a second submit of the same form, before the next question was loaded
+    response = client.post(f'/answerQuiz/{room_id}/', data={'questionId': questionId, 'answerNumber': '0'},
+                           follow_redirects=True)
+    assert 'You already answered that question' in response.get_data(as_text=True)
+    # once the next question is served, the first one is no longer the current one
+    response = client.post(f'/answerQuiz/{room_id}/answer', json={'questionId': questionId, 'answerNumber': 1})
+    assert response.status_code == 409
+
+    results = list(repository.getDb().results.find({"roomId": ObjectId(room_id), "user": 'alice'}))
+    assert len(results) == 1
+    assert [answer['answerNumber'] for answer in results[0]['answers']] == [1]
+    assert repository.findRoomStats(room_id)['counts'] == {questionId: {'1': 1}}
+    assert app.test_client().get(f'/rooms/{room_id}/leaderboard').get_json()['leaders'] == [
+        {'user': 'alice', 'score': 1000, 'rank': 1}]
+
+
+def test_racingAnswersToTheServedQuestionRecordOne(app, makeRoom, player, servedQuestionId):
+    room_id = makeRoom()
+    client = player(room_id, 'alice')
+    questionId = ObjectId(servedQuestionId(client, room_id))
+    answer = {'questionId': questionId, 'answerNumber': 1, 'correct': True}
+
+    # both requests passed the delivery check before either one wrote
+    assert repository.pushAnswer(room_id, 'alice', answer, 1000)
+    assert not repository.pushAnswer(room_id, 'alice', dict(answer, answerNumber=0), 1000)
+
+    result = repository.findResult(room_id, 'alice')
+    assert len(result['answers']) == 1
+    assert result['score'] == 1000
+
+
+def test_answerToAQuestionNotServedIsRejected(app, makeRoom, player, servedQuestionId):
+    room_id = makeRoom(questions=3)
+    client = player(room_id, 'alice')
+    servedQuestionId(client, room_id)
+    lastId = str(repository.findRoomQuestions(ObjectId(room_id))[-1]['_id'])
+
+    response = client.post(f'/answerQuiz/{room_id}/answer', json={'questionId': lastId, 'answerNumber': 1})
+    assert response.status_code == 409
+    assert repository.findResult(room_id, 'alice')['answers'] == []
+    assert repository.findRoomStats(room_id)['counts'] == {}
+
+
+def test_nicknameJoinsOnce(app, makeRoom, player):
+    room_id = makeRoom()
+    player(room_id, 'alice')
+    response = app.test_client().post('/enterQuiz', data={'username': 'alice', 'room_code': room_id},
+                                      follow_redirects=True)
+    assert 'Nickname already Taken' in response.get_data(as_text=True)
+    assert not repository.joinRoom(room_id, 'alice')
+
+    assert repository.countMembers(room_id) == 1
+    assert repository.findRoom(room_id)['joinedCount'] == 1
@@ -0,0 +1,94 @@
+import io
+
+import pytest
+
+import bulk
+
+
+def answer(number, text, correct=False):
+    return {'number': number, 'text': text, 'bgColor': '#eeeeee', 'textColor': '#212529', 'correct': correct}
+
+
+def csvLines(text):
+    return io.StringIO(text, newline='')
+
+
+def test_validateQuestionFillsDefaults():
+    question = bulk.validateQuestion({'text': 'Capital of Poland?', 'answers': [{'text': 'Warsaw', 'correct': 'yes'},
+                                                                                {'text': 'Helsinki'}]})
+    assert question == {'text': 'Capital of Poland?', 'answers': [answer(0, 'Warsaw', True), answer(1, 'Helsinki')]}
+
+
+@pytest.mark.parametrize('question, message', [
+    ([], 'must be an object'),
+    ({'text': ' ', 'answers': [{'text': 'a'}]}, 'text is missing'),
+    ({'text': 'q', 'answers': []}, 'at least one answer'),
+    ({'text': 'q', 'answers': [{'number': 1, 'text': 'a'}]}, 'numbered 0, 1, 2'),
+    ({'text': 'q', 'answers': [{'text': ''}]}, 'has no text'),
+    ({'text': 'q', 'answers': [{'text': 'a', 'bgColor': 'red'}]}, 'invalid color'),
+    ({'text': 'q', 'answers': [{'text': 'a', 'correct': 'maybe'}]}, 'true or false'),
+    ({'text': 'q', 'answers': [{'text': 'a'}], 'timeLimit': 0}, 'timeLimit'),
+])
+def test_validateQuestionRejects(question, message):
+    with pytest.raises(bulk.InvalidQuestion, match=message):
+        bulk.validateQuestion(question)
+
+
+@pytest.mark.parametrize('value, expected', [(None, None), ('', None), ('20', 20), (7.5, 7.5), (bulk.MAX_TIME_LIMIT, bulk.MAX_TIME_LIMIT)])
+def test_parseTimeLimit(value, expected):
+    assert bulk.parseTimeLimit(value) == expected
+
+
+@pytest.mark.parametrize('value', ['soon', -1, True, bulk.MAX_TIME_LIMIT + 1, float('nan')])
+def test_parseTimeLimitRejects(value):
+    with pytest.raises(bulk.InvalidQuestion):
+        bulk.parseTimeLimit(value)
+
+
+def test_parseQuestionsJsonlReportsBadLines():
+    lines = ['{"text": "q", "answers": [{"text": "a", "correct": true}], "timeLimit": 10}\n', '\n', '{"text": \n',
+             '{"text": "q"}\n']
+    parsed = list(bulk.parseQuestionsJsonl(lines))
+    assert parsed[0] == (1, {'text': 'q', 'answers': [answer(0, 'a', True)], 'timeLimit': 10})
+    assert [lineNumber for lineNumber, question in parsed] == [1, 3, 4]
+    assert 'invalid JSON' in str(parsed[1][1])
+    assert isinstance(parsed[2][1], bulk.InvalidQuestion)
+
+
+def test_parseQuestionsCsvGroupsAnswers():
+    parsed = list(bulk.parseQuestionsCsv(csvLines(
+        'question,number,text,bgColor,textColor,correct,timeLimit\n'
+        'Capital of Poland?,0,Warsaw,,,true,20\n'
+        ',1,Helsinki,,,false,\n'
+        'Longest play?,0,Hamlet,,,yes,\n')))
+    assert parsed == [(2, {'text': 'Capital of Poland?', 'answers': [answer(0, 'Warsaw', True), answer(1, 'Helsinki')],
+                           'timeLimit': 20}),
+                      (4, {'text': 'Longest play?', 'answers': [answer(0, 'Hamlet', True)]})]
+
+
+def test_parseQuestionsCsvReportsAnswerBeforeQuestion():
+    parsed = list(bulk.parseQuestionsCsv(csvLines(
+        'question,number,text,bgColor,textColor,correct\n'
+        'q,1,orphan,,,true\n'
+        'q,0,a,,,true\n')))
+    assert parsed[0][0] == 2
+    assert isinstance(parsed[0][1], bulk.InvalidQuestion)
+    assert parsed[1] == (3, {'text': 'q', 'answers': [answer(0, 'a', True)]})
+
+
+def test_importQuestionsBatchesAndCollectsErrors():
+    batches = []
+    parsed = [(1, {'text': 'a'}), (2, bulk.InvalidQuestion('bad')), (3, {'text': 'b'}), (4, {'text': 'c'})]
+    imported, errors = bulk.importQuestions(iter(parsed), batches.append, batchSize=2)
+    assert imported == 3
+    assert errors == [(2, 'bad')]
+    assert batches == [[{'text': 'a'}, {'text': 'b'}], [{'text': 'c'}]]
+
+
+@pytest.mark.parametrize('fileFormat', ['jsonl', 'csv'])
+def test_exportedQuestionsParseBack(fileFormat):
+    questions = [{'text': 'q, "quoted"', 'answers': [answer(0, 'a', True), answer(1, 'b')], 'timeLimit': 15},
+                 {'text': 'untimed', 'answers': [answer(0, 'c')]}]
+    exported = ''.join(bulk.QUESTION_EXPORTERS[fileFormat](questions))
+    parsed = list(bulk.PARSERS[fileFormat](csvLines(exported) if fileFormat == 'csv' else exported.splitlines()))
+    assert [question for lineNumber, question in parsed] == questions
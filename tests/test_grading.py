@@ -0,0 +1,84 @@
+import types
+import time
+
+import pytest
+from bson.objectid import ObjectId
+
+import grading
+
+
+@pytest.mark.parametrize('correct, elapsed, timeLimit, points', [
+    (False, 1, None, 0),
+    (True, None, None, 1000),
+    (True, 0, 10, 1000),
+    (True, 4, 10, 800),
+    (True, 10, 10, 500),
+    (True, 10.5, 10, 500), # within the grace
+    (True, 12, 10, 0),
+    (True, None, 10, 0), # never delivered
+])
+def test_answerPoints(correct, elapsed, timeLimit, points):
+    assert grading.answerPoints(correct, elapsed, timeLimit, 1000, grace=1) == points
+
+
+def test_timeBucket():
+    assert grading.timeBucket(0) == 0
+    assert grading.timeBucket(0.5) == 0
+    assert grading.timeBucket(0.6) == 1
+    assert grading.timeBucket(1000) == len(grading.ANSWER_TIME_BUCKETS)
+
+
+def test_timePercentiles():
+    # 2 answers under half a second, 2 between 1 and 1.5 seconds
+    assert grading.timePercentiles({'0': 2, '2': 2}, [0.25, 0.5, 0.75, 1]) == [0.25, 0.5, 1.25, 1.5]
+    assert grading.timePercentiles({}, [0.5]) == [None]
+    assert grading.timePercentiles({str(len(grading.ANSWER_TIME_BUCKETS)): 1}, [0.5]) == [None]
+
+
+def test_correctBits():
+    first, second, third = ObjectId(), ObjectId(), ObjectId()
+    answers = [{'number': 0, 'text': 'a', 'bgColor': '#eeeeee', 'textColor': '#212529', 'correct': False},
+               {'number': 1, 'text': 'b', 'bgColor': '#eeeeee', 'textColor': '#212529', 'correct': True}]
+    answerKey = grading.compileAnswerKey([{'_id': questionId, 'text': 'q', 'answers': answers}
+                                          for questionId in (first, second, third)])
+    bits = grading.correctBits(answerKey, [{'questionId': first, 'answerNumber': 1},
+                                           {'questionId': second, 'answerNumber': 0},
+                                           {'questionId': third, 'answerNumber': 1},
+                                           {'questionId': ObjectId(), 'answerNumber': 1}])
+    assert bits == 0b101
+    assert grading.countBits(bits) == 2
+
+
+# the clock the app reads is moved by hand, only time.time is replaced so sessions still sign normally
+@pytest.fixture
+def clock(monkeypatch):
+    import index
+    clock = types.SimpleNamespace(now=time.time())
+    monkeypatch.setattr(index, 'time', types.SimpleNamespace(time=lambda: clock.now, monotonic=time.monotonic,
+                                                             perf_counter=time.perf_counter, sleep=time.sleep))
+    return clock
+
+
+def test_timedAnswersScoreByDeliveryTime(app, clock, makeRoom, player, servedQuestionId):
+    room_id = makeRoom(timeLimit=10)
+    for nickname, delay, answerNumber in [('fast', 0, 1), ('slow', 4, 1), ('late', 12, 1), ('wrong', 0, 0)]:
+        client = player(room_id, nickname)
+        questionId = servedQuestionId(client, room_id)
+        clock.now += delay
+        client.post(f'/answerQuiz/{room_id}/', data={'questionId': questionId, 'answerNumber': str(answerNumber)})
+
+    leaders = app.test_client().get(f'/rooms/{room_id}/leaderboard').get_json()['leaders']
+    assert [(leader['user'], leader['score']) for leader in leaders] == [('fast', 1000), ('slow', 800), ('late', 0),
+                                                                         ('wrong', 0)]
+
+
+def test_playersWithoutAnswersAreNotRanked(app, clock, makeRoom, player):
+    room_id = makeRoom(timeLimit=10)
+    client = player(room_id, 'watcher')
+    assert client.get(f'/answerQuiz/{room_id}/').status_code == 200
+
+    leaderboard = app.test_client()
+    assert leaderboard.get(f'/rooms/{room_id}/leaderboard').get_json() == {'leaders': []}
+    assert leaderboard.get(f'/rooms/{room_id}/leaderboard/watcher').status_code == 404
+    response = client.get(f'/results/{room_id}', follow_redirects=True)
+    assert 'You have not answered any questions yet' in response.get_data(as_text=True)